@@ -5,11 +5,13 @@
 
 import psycopg2
 
+import dbpool
+
 DATABASE_NAME = 'postgres'
 
 
 def getopenconnection(user='postgres', password='12052004', dbname='postgres'):
-    return psycopg2.connect("dbname='" + dbname + "' user='" + user + "' host='localhost' password='" + password + "'")
+    return dbpool.get_pool(dbname=dbname, user=user, host='localhost', password=password).getconn()
 
 
 def loadratings(ratingstablename, ratingsfilepath, openconnection): 
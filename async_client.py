@@ -0,0 +1,211 @@
+import asyncio
+
+import cluster
+import dbpool
+import main
+import metrics
+from main import USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME, RANGE_TABLE_PREFIX, RROBIN_TABLE_PREFIX, \
+    RROBIN_CURSOR_SEQUENCE, DATABASE_NAME, DB_USER_PG_DEFAULT, DB_PASS_PG_DEFAULT, DB_HOST_PG_DEFAULT, \
+    DB_PORT_PG_DEFAULT
+from metrics import METRICS
+
+try:
+    from psycopg import errors
+    from psycopg.conninfo import make_conninfo
+    from psycopg.pq import TransactionStatus
+    from psycopg_pool import AsyncConnectionPool
+except ImportError:  # psycopg 3 is only needed by this module; everything else uses psycopg2
+    AsyncConnectionPool = None
+
+logger = metrics.get_logger(__name__)
+
+# Connections shared by every coroutine of a client; further concurrent inserts wait for one
+ASYNC_POOL_MIN_CONNECTIONS = 1
+ASYNC_POOL_MAX_CONNECTIONS = 20
+
+_INSERT_SQL = f"INSERT INTO {{}} ({USER_ID_COLNAME}, {MOVIE_ID_COLNAME}, {RATING_COLNAME}) VALUES (%s, %s, %s);"
+
+
+class _SchemeDropped(Exception):
+    # Raised by _pin_scheme when the cached scheme's metadata no longer exists
+    pass
+
+
+class _AsyncNodeTransactions:
+    """
+    Node transactions of one insert, as main._NodeTransactions: they stay open until commit(),
+    run once the coordinator transaction has committed, and are rolled back otherwise.
+    """
+    def __init__(self, client):
+        self._client = client
+        self._conns = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for node, node_conn in self._conns.items():
+            if node_conn.info.transaction_status != TransactionStatus.IDLE:
+                await node_conn.rollback()
+            await (await self._client._node_pool(node)).putconn(node_conn)
+        self._conns = {}
+
+    async def connection(self, node):
+        if node not in self._conns:
+            self._conns[node] = await (await self._client._node_pool(node)).getconn()
+        return self._conns[node]
+
+    async def commit(self):
+        for node_conn in self._conns.values():
+            await node_conn.commit()
+
+
+class AsyncPartitionClient:
+    """
+    asyncio counterpart of rangeinsert, roundrobininsert and hashinsert. Inserts share a psycopg 3
+    AsyncConnectionPool, are routed with the cached partition metadata and send their statements
+    in pipeline mode, so thousands of concurrent inserts need neither a thread nor a connection each.
+    Use it as `async with AsyncPartitionClient(...) as client: await client.rangeinsert(...)`.
+    """
+    def __init__(self, dbname=DATABASE_NAME, user=DB_USER_PG_DEFAULT, password=DB_PASS_PG_DEFAULT,
+                 host=DB_HOST_PG_DEFAULT, port=DB_PORT_PG_DEFAULT,
+                 min_size=ASYNC_POOL_MIN_CONNECTIONS, max_size=ASYNC_POOL_MAX_CONNECTIONS):
+        if AsyncConnectionPool is None:
+            raise ImportError("async_client needs psycopg 3 and psycopg_pool: pip install 'psycopg[binary]' psycopg_pool")
+        self._params = {'dbname': dbname, 'user': user, 'password': password, 'host': host, 'port': port}
+        self._pool = AsyncConnectionPool(make_conninfo(**self._params), min_size=min_size, max_size=max_size, open=False)
+        self._max_size = max_size
+        self._node_pools = {}
+        self._node_pools_lock = asyncio.Lock()
+
+    async def open(self):
+        await self._pool.open()
+        return self
+
+    async def close(self):
+        for pool in self._node_pools.values():
+            await pool.close()
+        self._node_pools.clear()
+        await self._pool.close()
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _load_scheme(self, prefix):
+        with dbpool.connection(**self._params) as conn:
+            scheme = main.get_partition_catalog(conn).get(conn, prefix)
+            # Bootstrapping partitions without metadata records their scheme and seeds the cursor
+            conn.commit()
+        return scheme
+
+    async def _pin_scheme(self, conn, prefix):
+        # main._pin_partition_scheme over the async connection, in its open transaction. The catalog
+        # is shared with main; schemes are (re)loaded by the synchronous loader in a worker thread.
+        catalog = main.get_partition_catalog(conn)
+        await conn.execute(main.PIN_PARTITION_SCHEME_SQL, (prefix,))
+        _, scheme = catalog.lookup(prefix)
+        if scheme is not None:
+            try:
+                # Pipelined behind the lock, so both cost one round trip
+                cursor = await conn.execute(main.PARTITION_VERSION_SQL, (prefix,))
+                row = await cursor.fetchone()
+            except errors.UndefinedTable as e:
+                # The metadata was dropped, and with it the partitions this scheme described
+                catalog.invalidate(prefix)
+                raise _SchemeDropped(prefix) from e
+            if row is not None and row[0] == scheme.version:
+                return scheme
+        catalog.invalidate(prefix)
+        return await asyncio.to_thread(self._load_scheme, prefix)
+
+    async def _node_pool(self, node):
+        async with self._node_pools_lock:
+            pool = self._node_pools.get(node)
+            if pool is None:
+                pool = AsyncConnectionPool(make_conninfo(**cluster.node_params(node)), min_size=0,
+                                           max_size=self._max_size, open=False)
+                await pool.open()
+                self._node_pools[node] = pool
+        return pool
+
+    async def _write_partition(self, conn, nodes, scheme, partition_index, params):
+        # Remote partitions are written in the open node transactions of @nodes, which the
+        # caller commits after the coordinator transaction, as in main.
+        table_name = scheme.table_name(partition_index)
+        node = scheme.node_of(partition_index)
+        target = conn if node is None else await nodes.connection(node)
+        await target.execute(_INSERT_SQL.format(table_name), params)
+        METRICS.increment('rows_routed', table_name)
+
+    async def _insert(self, prefix, write):
+        # One insert transaction: the scheme of @prefix is pinned, then write(conn, nodes, scheme)
+        # sends the inserts. A cached scheme whose metadata was dropped fails the pin and aborts
+        # the transaction; it is then run once more without that scheme, as main does.
+        for retry in (False, True):
+            try:
+                async with self._pool.connection() as conn, _AsyncNodeTransactions(self) as nodes:
+                    async with conn.transaction(), conn.pipeline():
+                        await write(conn, nodes, await self._pin_scheme(conn, prefix))
+                    await nodes.commit()
+                return
+            except _SchemeDropped:
+                if retry:
+                    raise
+
+    async def rangeinsert(self, ratingsTableName, userid, movieid, rating):
+        params = (userid, movieid, float(rating))
+
+        async def write(conn, nodes, scheme):
+            await conn.execute(_INSERT_SQL.format(ratingsTableName.lower()), params)
+            if scheme is None:
+                return
+            partition_index = scheme.route_rating(params[2])
+            if partition_index is None:
+                logger.warning("Rating %s does not fall into any defined range partition. Skipping insert into partition.", rating)
+                return
+            await self._write_partition(conn, nodes, scheme, partition_index, params)
+
+        try:
+            await self._insert(RANGE_TABLE_PREFIX, write)
+        except Exception as e:
+            logger.error("Error during Async_Range_Insert: %s", e)
+            raise
+
+    async def roundrobininsert(self, ratingsTableName, userid, movieid, rating):
+        params = (userid, movieid, float(rating))
+
+        async def write(conn, nodes, scheme):
+            await conn.execute(_INSERT_SQL.format(ratingsTableName.lower()), params)
+            if scheme is None:
+                return
+            # The base insert and nextval() travel together; only the slot is waited for.
+            cursor = await conn.execute(f"SELECT nextval('{RROBIN_CURSOR_SEQUENCE}');")
+            cursor_value = (await cursor.fetchone())[0]
+            await self._write_partition(conn, nodes, scheme, cursor_value % scheme.num_partitions, params)
+
+        try:
+            await self._insert(RROBIN_TABLE_PREFIX, write)
+        except Exception as e:
+            logger.error("Error during Async_RoundRobin_Insert: %s", e)
+            raise
+
+    async def hashinsert(self, ratingsTableName, userid, movieid, rating, prefix=None):
+        actual_base_table_name = ratingsTableName.lower()
+        prefix = prefix or main.hash_table_prefix(actual_base_table_name)
+        params = (userid, movieid, float(rating))
+
+        async def write(conn, nodes, scheme):
+            await conn.execute(_INSERT_SQL.format(actual_base_table_name), params)
+            if scheme is None:
+                return
+            key_value = userid if scheme.key_column == USER_ID_COLNAME else movieid
+            await self._write_partition(conn, nodes, scheme, scheme.route_key(key_value), params)
+
+        try:
+            await self._insert(prefix, write)
+        except Exception as e:
+            logger.error("Error during Async_Hash_Insert: %s", e)
+            raise
@@ -0,0 +1,178 @@
+#
+# Non-interactive benchmark for the load / partition / insert paths.
+# Example: python benchmark.py --rows 1000000 10000000 --partitions 1 5 20 --output bench.json
+#
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import main
+import metrics
+import testHelper
+
+try:
+    import numpy as np
+except ImportError:  # the generator falls back to the random module
+    np = None
+
+BENCHMARK_DATABASE = 'dds_bench'
+RATINGS_TABLE = 'ratings'
+DEFAULT_ROWS = (1000000,)
+DEFAULT_PARTITIONS = (1, 5, 20)
+DEFAULT_INSERTS = 1000
+DEFAULT_SKEW = 1.0
+NUM_USERS = 70000
+NUM_MOVIES = 10000
+# MovieLens ratings are given in half stars
+RATING_VALUES = [i / 2 for i in range(1, 11)]
+GENERATOR_CHUNK_ROWS = 500000
+
+
+def _weights(count, skew):
+    # Zipf-like popularity: item k gets weight 1 / k^skew, so skew 0 is uniform
+    return [1.0 / (k ** skew) for k in range(1, count + 1)]
+
+def _rating_chunk(rows, skew, rng):
+    if np is not None:
+        def draw(count, values):
+            weights = np.array(_weights(count, skew))
+            return rng.choice(values, size=rows, p=weights / weights.sum())
+        userids = draw(NUM_USERS, np.arange(1, NUM_USERS + 1))
+        movieids = draw(NUM_MOVIES, np.arange(1, NUM_MOVIES + 1))
+        # Skew also pulls ratings towards the top of the scale, as in real rating data
+        ratings = draw(len(RATING_VALUES), np.array(RATING_VALUES[::-1]))
+        timestamps = rng.integers(789652009, 1231131736, size=rows)
+        return zip(userids.tolist(), movieids.tolist(), ratings.tolist(), timestamps.tolist())
+    user_weights, movie_weights = _weights(NUM_USERS, skew), _weights(NUM_MOVIES, skew)
+    userids = rng.choices(range(1, NUM_USERS + 1), user_weights, k=rows)
+    movieids = rng.choices(range(1, NUM_MOVIES + 1), movie_weights, k=rows)
+    ratings = rng.choices(RATING_VALUES[::-1], _weights(len(RATING_VALUES), skew), k=rows)
+    timestamps = [rng.randint(789652009, 1231131736) for _ in range(rows)]
+    return zip(userids, movieids, ratings, timestamps)
+
+def generate_ratings_file(path, rows, skew=DEFAULT_SKEW, seed=0):
+    """
+    Write @rows synthetic ratings in test_data.dat format (userid::movieid::rating::timestamp).
+    Userids and movieids follow a Zipf-like distribution with exponent @skew.
+    """
+    rng = np.random.default_rng(seed) if np is not None else random.Random(seed)
+    with open(path, 'w') as f:
+        for offset in range(0, rows, GENERATOR_CHUNK_ROWS):
+            chunk = _rating_chunk(min(GENERATOR_CHUNK_ROWS, rows - offset), skew, rng)
+            f.write(''.join(f"{u}::{m}::{r}::{t}\n" for u, m, r, t in chunk))
+    return path
+
+def _reset_peak_rss():
+    # Linux: writing 5 to clear_refs resets VmHWM, so the next reading covers one operation only
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def _peak_rss_mb(since_reset):
+    if since_reset:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    # Elsewhere only the high-water mark of the whole process is available;
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _measure(results, operation, rows, function, *args, **extra):
+    # Output of the measured call is discarded so printing does not dominate the timings
+    per_operation = _reset_peak_rss()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        function(*args)
+    seconds = time.perf_counter() - start
+    result = dict({'operation': operation, 'rows': rows, 'seconds': round(seconds, 4),
+                   'rows_per_sec': round(rows / seconds, 1) if seconds > 0 else None,
+                   'peak_rss_mb': round(_peak_rss_mb(per_operation), 1),
+                   'peak_rss_scope': 'operation' if per_operation else 'process'}, **extra)
+    results.append(result)
+    print(f"  {operation:<20} {json.dumps(extra):<28} {seconds:9.3f}s {result['rows_per_sec'] or 0:>12.0f} rows/s")
+    return result
+
+def _reset_database(conn):
+    testHelper.deleteAllPublicTables(conn)
+    main._execute_query_pg_with_provided_conn(conn, f"DROP SEQUENCE IF EXISTS {main.RROBIN_CURSOR_SEQUENCE};")
+    conn.commit()
+    main.invalidate_partition_catalog(conn)
+
+def _run_inserts(insert, conn, count, seed):
+    rng = random.Random(seed)
+    for _ in range(count):
+        insert(RATINGS_TABLE, rng.randint(1, NUM_USERS), rng.randint(1, NUM_MOVIES), rng.choice(RATING_VALUES), conn)
+
+def run_benchmark(conn, ratings_path, rows, partition_counts, inserts):
+    results = []
+    _reset_database(conn)
+    _measure(results, 'loadratings', rows, main.loadratings, RATINGS_TABLE, ratings_path, conn)
+    for n in partition_counts:
+        _measure(results, 'rangepartition', rows, main.rangepartition, RATINGS_TABLE, n, conn, partitions=n)
+        _measure(results, 'roundrobinpartition', rows, main.roundrobinpartition, RATINGS_TABLE, n, conn, partitions=n)
+        _measure(results, 'rangeinsert', inserts, _run_inserts, main.rangeinsert, conn, inserts, n, partitions=n)
+        _measure(results, 'roundrobininsert', inserts, _run_inserts, main.roundrobininsert, conn, inserts, n, partitions=n)
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark loadratings, partitioning and inserts against a local PostgreSQL.")
+    parser.add_argument('--rows', type=int, nargs='+', default=list(DEFAULT_ROWS), help="synthetic file sizes")
+    parser.add_argument('--partitions', type=int, nargs='+', default=list(DEFAULT_PARTITIONS), help="values of N")
+    parser.add_argument('--inserts', type=int, default=DEFAULT_INSERTS, help="single-row inserts per N")
+    parser.add_argument('--skew', type=float, default=DEFAULT_SKEW, help="Zipf exponent, 0 for uniform data")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', default=BENCHMARK_DATABASE)
+    parser.add_argument('--data-dir', default=None, help="where generated files go (default: a temporary directory)")
+    parser.add_argument('--output', default='benchmark_results.json')
+    return parser.parse_args(argv)
+
+def main_benchmark(argv=None):
+    args = parse_args(argv)
+    main.create_db_if_not_exists(args.database)
+    conn = main.getopenconnection(dbname=args.database)
+    conn.autocommit = False
+    report = {'commit': _git_commit(), 'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'python': platform.python_version(), 'numpy': np.__version__ if np is not None else None,
+              'settings': vars(args), 'runs': []}
+    metrics.METRICS.reset()
+    with tempfile.TemporaryDirectory() as tmp:
+        data_dir = args.data_dir or tmp
+        for rows in args.rows:
+            path = os.path.join(data_dir, f"ratings_{rows}_skew{args.skew:g}.dat")
+            if not os.path.exists(path):
+                print(f"Generating {rows} ratings into '{path}'...")
+                generate_ratings_file(path, rows, args.skew, args.seed)
+            print(f"Benchmarking {rows} rows:")
+            results = run_benchmark(conn, path, rows, args.partitions, args.inserts)
+            report['runs'].append({'rows': rows, 'skew': args.skew, 'results': results})
+    report['metrics'] = metrics.METRICS.snapshot()
+    _reset_database(conn)
+    conn.close()
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to '{args.output}'.")
+    return report
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -0,0 +1,64 @@
+import threading
+
+import psycopg2.extensions
+
+import dbpool
+
+# Placement entry of partitions kept in the database the caller is connected to
+LOCAL_NODE = 'local'
+
+_NODES = {}
+_NODES_LOCK = threading.Lock()
+
+
+def register_node(name, dsn):
+    """
+    Make the PostgreSQL database at @dsn available as node @name for partition placement.
+    Only node names are stored in partition_meta; connection details, passwords included, are
+    kept in this process, so every process that touches remote partitions registers the nodes.
+    :param dsn: libpq connection string or URI, or a dict of connection parameters
+    """
+    if name == LOCAL_NODE:
+        raise ValueError(f"'{LOCAL_NODE}' is reserved for the coordinator database.")
+    params = psycopg2.extensions.parse_dsn(dsn) if isinstance(dsn, str) else dict(dsn)
+    with _NODES_LOCK:
+        _NODES[name] = params
+
+def unregister_node(name):
+    with _NODES_LOCK:
+        params = _NODES.pop(name, None)
+    if params is not None:
+        dbpool.close_pool(**params)
+
+def registered_nodes():
+    with _NODES_LOCK:
+        return sorted(_NODES)
+
+def node_params(name):
+    with _NODES_LOCK:
+        params = _NODES.get(name)
+    if params is None:
+        raise ValueError(f"Node '{name}' is not registered. Call cluster.register_node() first.")
+    return dict(params)
+
+def node_pool(name):
+    return dbpool.get_pool(**node_params(name))
+
+def pool_for_node(conn, name):
+    # Partitions without a node live next to the coordinator connection @conn
+    return dbpool.pool_for(conn) if name is None else node_pool(name)
+
+def placement_for(num_partitions, nodes):
+    """
+    Assign partitions to @nodes in turn: partition i goes to nodes[i % len(nodes)].
+    :return: one node name per partition, None for partitions kept on the coordinator
+    """
+    if not nodes:
+        return None
+    placement = [None if node == LOCAL_NODE else node for node in nodes]
+    for node in placement:
+        if node is not None:
+            node_params(node)
+    if not any(placement):
+        return None
+    return [placement[i % len(placement)] for i in range(num_partitions)]
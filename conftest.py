@@ -0,0 +1,28 @@
+import psycopg2
+import pytest
+
+import main
+import testHelper
+
+
+# Scratch database of the tests that run against PostgreSQL; skipped when no server is reachable
+TEST_DATABASE = 'dds_assgn1_test'
+
+
+@pytest.fixture
+def autocommit_conn():
+    # An autocommit connection, as the tester and testHelper use, in a database of its own
+    try:
+        main.create_db_if_not_exists(TEST_DATABASE)
+        conn = main.getopenconnection(dbname=TEST_DATABASE)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"PostgreSQL is not available: {e}")
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    testHelper.deleteAllPublicTables(conn)
+    main.invalidate_partition_catalog(conn)
+    try:
+        yield conn
+    finally:
+        testHelper.deleteAllPublicTables(conn)
+        main.invalidate_partition_catalog(conn)
+        conn.close()
@@ -0,0 +1,258 @@
+import mmap
+import os
+from array import array
+
+try:
+    import numpy as np
+except ImportError:  # columns come back as array.array and lines are split one by one
+    np = None
+
+# Bytes of the file handed to the parser at once; chunks always end on a line boundary
+PARSE_CHUNK_BYTES = 8 * 1024 * 1024
+FIELD_SEPARATOR = b'::'
+# Irregular blocks (blank or malformed lines) are halved until this size before being parsed line by line
+LINE_PARSE_BLOCK_BYTES = 64 * 1024
+# Column types for parse_dat_bytes: array typecodes for numbers, 's' for UTF-8 text
+_NUMPY_DTYPES = {'i': 'int32', 'q': 'int64', 'd': 'float64'}
+
+
+def iter_byte_chunks(filePath, chunk_bytes=PARSE_CHUNK_BYTES, start=0, end=None):
+    """
+    Memory-map @filePath and yield it in pieces of about @chunk_bytes that end on a newline,
+    so every chunk holds whole lines and no per-line objects are created while reading.
+    @start and @end restrict reading to a byte range that begins and ends on line boundaries.
+    """
+    if chunk_bytes <= 0:
+        raise ValueError("chunk_bytes must be greater than 0.")
+    with open(filePath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        end = size if end is None else min(end, size)
+        if start >= end:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            position = start
+            while position < end:
+                stop = min(position + chunk_bytes, end)
+                if stop < end:
+                    newline = mm.rfind(b'\n', position, stop)
+                    if newline < 0:
+                        # A single line longer than a chunk: extend to its end
+                        newline = mm.find(b'\n', stop, end)
+                    stop = end if newline < 0 else newline + 1
+                yield mm[position:stop]
+                position = stop
+
+def line_aligned_ranges(filePath, parts):
+    """
+    Split @filePath into at most @parts (start, end) byte ranges of similar size, each starting
+    at the beginning of a line and ending just after a newline (or at the end of the file).
+    """
+    if parts <= 0:
+        raise ValueError("parts must be greater than 0.")
+    with open(filePath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            bounds = [0]
+            for k in range(1, parts):
+                target = max(size * k // parts, bounds[-1] + 1)
+                newline = mm.find(b'\n', target - 1)
+                cut = size if newline < 0 else newline + 1
+                if cut >= size:
+                    break
+                if cut > bounds[-1]:
+                    bounds.append(cut)
+            bounds.append(size)
+    return list(zip(bounds, bounds[1:]))
+
+# Bytes a block parsed by NumPy may hold; anything else (text, spaces, tabs) goes line by line
+_NUMERIC_BLOCK_BYTES = b'0123456789+-.eE:\r\n'
+# Integer columns are parsed as float64 and must stay within their type, and for 'q' within
+# the integers float64 holds exactly
+_INTEGER_LIMITS = {'i': (-2 ** 31, 2 ** 31 - 1), 'q': (1 - 2 ** 53, 2 ** 53 - 1)}
+
+def _field_bounds(codes, fields):
+    # (starts, ends) of every field as (rows, fields) arrays, or None unless every line has
+    # exactly @fields non-empty fields. A '\r' is only allowed as part of a line break.
+    size = len(codes)
+    if ord('\r') in codes:
+        carriage = np.flatnonzero(codes == ord('\r'))
+        if np.any(codes[carriage[carriage + 1 < size] + 1] != ord('\n')):
+            return None
+    line_ends = np.flatnonzero(codes == ord('\n'))
+    if codes[-1] != ord('\n'):
+        line_ends = np.append(line_ends, size)
+    rows = len(line_ends)
+    # The colons are known to come in separate pairs, so every other one starts a separator.
+    separators = np.flatnonzero(codes == ord(':'))[::2]
+    per_line = np.diff(np.searchsorted(separators, line_ends), prepend=0)
+    if np.any(per_line != fields - 1):
+        return None
+    separators = separators.reshape(rows, fields - 1)
+    starts = np.empty((rows, fields), dtype=np.int64)
+    ends = np.empty((rows, fields), dtype=np.int64)
+    starts[0, 0] = 0
+    starts[1:, 0] = line_ends[:-1] + 1
+    starts[:, 1:] = separators + 2
+    ends[:, :-1] = separators
+    ends[:, -1] = line_ends - (codes[np.maximum(line_ends - 1, 0)] == ord('\r'))
+    if np.any(ends <= starts):
+        return None
+    return starts, ends
+
+def _parse_numeric_block(data, column_types):
+    # The whole block in one call: '::' becomes whitespace and NumPy converts every number in C.
+    # Returns None, so the caller parses the block line by line, unless the result is the one
+    # the per-line parser would give: every line has one non-empty field per column, integer
+    # fields hold plain integers within their type ('d' columns are not checked), and nothing
+    # but '::' and line breaks separates the numbers. Blocks the per-line parser rejects (int()
+    # of a float, an id beyond INT) therefore raise its errors instead of loading wrong values.
+    fields = len(column_types)
+    if data.translate(None, _NUMERIC_BLOCK_BYTES) or b':::' in data \
+            or data.count(b':') != 2 * data.count(FIELD_SEPARATOR):
+        return None
+    codes = np.frombuffer(data, dtype=np.uint8)
+    bounds = _field_bounds(codes, fields)
+    if bounds is None:
+        return None
+    starts, ends = bounds
+    integer_columns = [i for i, t in enumerate(column_types) if t in _INTEGER_LIMITS]
+    if integer_columns:
+        # Field of every '.', 'e' and 'E'; fields are laid out in file order, so starts.ravel() is sorted
+        fractional = np.flatnonzero((codes == ord('.')) | (codes == ord('e')) | (codes == ord('E')))
+        columns = (np.searchsorted(starts.ravel(), fractional, side='right') - 1) % fields
+        if np.any(np.isin(columns, integer_columns)):
+            return None
+    try:
+        values = np.fromstring(data.replace(FIELD_SEPARATOR, b' '), dtype=np.float64, sep=' ')
+    except ValueError:
+        return None
+    if values.size != starts.size:
+        return None
+    values = values.reshape(starts.shape)
+    for i in integer_columns:
+        low, high = _INTEGER_LIMITS[column_types[i]]
+        if values[:, i].min() < low or values[:, i].max() > high:
+            return None
+    return values
+
+def _parse_in_blocks(data, fast, slow):
+    # One bad line would push a whole chunk onto the per-line path; halving the chunk around
+    # it keeps every regular block on the NumPy path.
+    result = fast(data) if np is not None and data else None
+    if result is not None:
+        return [result]
+    cut = data.rfind(b'\n', 0, len(data) // 2) if len(data) > LINE_PARSE_BLOCK_BYTES else -1
+    if cut < 0:
+        return [slow(data)]
+    return _parse_in_blocks(data[:cut + 1], fast, slow) + _parse_in_blocks(data[cut + 1:], fast, slow)
+
+def _first_line_fields(data):
+    newline = data.find(b'\n')
+    return (data if newline < 0 else data[:newline]).count(FIELD_SEPARATOR) + 1
+
+def _rating_block_fast(data):
+    fields = _first_line_fields(data)
+    # Fields after the rating (the timestamp) are parsed but not kept
+    values = _parse_numeric_block(data, 'iid' + 'd' * (fields - 3)) if fields >= 3 else None
+    if values is None:
+        return None
+    return values[:, 0].astype(np.int32), values[:, 1].astype(np.int32), values[:, 2].copy(), 0
+
+def _rating_block_lines(data):
+    userids, movieids, ratings = array('i'), array('i'), array('d')
+    skipped = 0
+    for line in data.splitlines():
+        parts = line.strip().split(FIELD_SEPARATOR)
+        if len(parts) < 3:
+            skipped += bool(line.strip())
+            continue
+        userids.append(int(parts[0]))
+        movieids.append(int(parts[1]))
+        ratings.append(float(parts[2]))
+    return userids, movieids, ratings, skipped
+
+def parse_rating_bytes(data):
+    """
+    Parse userid::movieid::rating[::timestamp] lines into columns. Extra fields are ignored,
+    lines with fewer than three fields are skipped and blank lines are ignored. A malformed
+    number raises ValueError and an id beyond the INT range OverflowError.
+    :return: (userids, movieids, ratings, skipped), NumPy arrays when NumPy is installed
+    """
+    blocks = _parse_in_blocks(data, _rating_block_fast, _rating_block_lines)
+    skipped = sum(block[3] for block in blocks)
+    if np is None:
+        columns = tuple(sum((block[i] for block in blocks[1:]), blocks[0][i]) for i in range(3))
+    else:
+        columns = tuple(np.concatenate([np.asarray(block[i], dtype=dtype) for block in blocks])
+                        for i, dtype in enumerate((np.int32, np.int32, np.float64)))
+    return columns + (skipped,)
+
+def _split_fields(line, fields):
+    # The last field is split from the right and the middle one keeps any '::' it contains,
+    # the same way loadmovies and loadtags split titles and tags.
+    parts = line.split(FIELD_SEPARATOR, fields - 2)
+    if len(parts) < fields - 1:
+        return None
+    tail = parts[-1].rsplit(FIELD_SEPARATOR, 1)
+    if len(tail) < 2:
+        return None
+    return parts[:-1] + tail
+
+def _dat_block_lines(data, column_types):
+    fields = len(column_types)
+    columns = [[] if t == 's' else array(t) for t in column_types]
+    skipped = 0
+    for line in data.splitlines():
+        if not line.strip():
+            continue
+        parts = _split_fields(line.rstrip(b'\r'), fields)
+        if parts is None:
+            skipped += 1
+            continue
+        for column, column_type, value in zip(columns, column_types, parts):
+            if column_type == 's':
+                column.append(value.decode('utf-8'))
+            elif column_type == 'd':
+                column.append(float(value))
+            else:
+                column.append(int(value))
+    return columns, skipped
+
+def _dat_block_fast(data, column_types):
+    if 's' in column_types:
+        return None
+    values = _parse_numeric_block(data, column_types)
+    if values is None:
+        return None
+    return [values[:, i].astype(_NUMPY_DTYPES[t]) for i, t in enumerate(column_types)], 0
+
+def parse_dat_bytes(data, column_types):
+    """
+    Parse '::' delimited lines with one column per entry of @column_types ('i', 'q', 'd' or 's').
+    Lines with fewer fields are skipped, blank lines are ignored. A malformed number raises
+    ValueError and a value beyond the range of its 'i' or 'q' column OverflowError.
+    :return: (columns, skipped); numeric columns are NumPy arrays or array.array, text columns lists of str
+    """
+    blocks = _parse_in_blocks(data, lambda block: _dat_block_fast(block, column_types),
+                              lambda block: _dat_block_lines(block, column_types))
+    skipped = sum(block_skipped for _, block_skipped in blocks)
+    columns = []
+    for i, column_type in enumerate(column_types):
+        parts = [block_columns[i] for block_columns, _ in blocks]
+        if column_type == 's':
+            columns.append([value for part in parts for value in part])
+        elif np is not None:
+            columns.append(np.concatenate([np.asarray(part, dtype=_NUMPY_DTYPES[column_type]) for part in parts]))
+        else:
+            columns.append(sum(parts[1:], parts[0]))
+    return columns, skipped
+
+def iter_rating_columns(filePath, chunk_bytes=PARSE_CHUNK_BYTES, start=0, end=None):
+    for data in iter_byte_chunks(filePath, chunk_bytes, start, end):
+        yield parse_rating_bytes(data)
+
+def iter_dat_columns(filePath, column_types, chunk_bytes=PARSE_CHUNK_BYTES):
+    for data in iter_byte_chunks(filePath, chunk_bytes):
+        yield parse_dat_bytes(data, column_types)
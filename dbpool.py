@@ -0,0 +1,154 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+# Pool sizing and checkout behaviour
+POOL_MIN_CONNECTIONS = 1
+POOL_MAX_CONNECTIONS = 10
+POOL_CHECKOUT_TIMEOUT = 30.0
+# Connections idle for longer than this are pinged before being handed out again
+HEALTH_CHECK_INTERVAL = 30.0
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    # close() hands the connection back to its pool instead of closing the socket, so
+    # existing callers that close what getopenconnection() returned keep working.
+    _pool = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._last_used = time.monotonic()
+
+    def close(self):
+        pool, self._pool = self._pool, None
+        if pool is not None and not self.closed:
+            pool.putconn(self)
+        else:
+            super().close()
+
+
+def is_usable(conn):
+    return (conn is not None and not conn.closed
+            and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN)
+
+
+class ConnectionPool:
+    def __init__(self, minconn=POOL_MIN_CONNECTIONS, maxconn=POOL_MAX_CONNECTIONS, **params):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.params = params
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn, maxconn, connection_factory=PooledConnection, **params)
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def _is_healthy(self, conn):
+        if not is_usable(conn):
+            return False
+        if time.monotonic() - conn._last_used < HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            if not conn.autocommit:
+                conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self, timeout=POOL_CHECKOUT_TIMEOUT):
+        if not self._slots.acquire(timeout=timeout):
+            raise psycopg2.pool.PoolError(f"No free connection in the pool after {timeout:.0f}s (max {self.maxconn}).")
+        try:
+            conn = self._pool.getconn()
+            while not self._is_healthy(conn):
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        conn._pool = self
+        return conn
+
+    def putconn(self, conn):
+        conn._pool = None
+        try:
+            if self._pool.closed:
+                conn.close()
+                return
+            keep = is_usable(conn)
+            if keep:
+                try:
+                    if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    if conn.autocommit:
+                        conn.autocommit = False
+                except psycopg2.Error:
+                    keep = False
+            conn._last_used = time.monotonic()
+            self._pool.putconn(conn, close=not keep)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def closeall(self):
+        for conn in list(self._pool._used.values()):
+            conn._pool = None
+        self._pool.closeall()
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def _pool_key(params):
+    # Pools never cross a fork: a child process gets its own connections.
+    return (os.getpid(),) + tuple(sorted((k, str(v)) for k, v in params.items() if v is not None))
+
+def get_pool(minconn=POOL_MIN_CONNECTIONS, maxconn=POOL_MAX_CONNECTIONS, **params):
+    key = _pool_key(params)
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            pool = _POOLS[key] = ConnectionPool(minconn, maxconn, **params)
+    return pool
+
+def connection_params(conn):
+    info = conn.info
+    return {'dbname': info.dbname, 'user': info.user, 'password': info.password,
+            'host': info.host, 'port': info.port}
+
+def pool_for(conn):
+    # The pool holding sessions to the same database as an existing connection
+    return get_pool(**connection_params(conn))
+
+@contextmanager
+def connection(**params):
+    with get_pool(**params).connection() as conn:
+        yield conn
+
+def close_pools(dbname=None):
+    with _POOLS_LOCK:
+        keys = [key for key, pool in _POOLS.items()
+                if dbname is None or str(pool.params.get('dbname')) == dbname]
+        pools = [_POOLS.pop(key) for key in keys]
+    for pool in pools:
+        pool.closeall()
+
+def close_pool(**params):
+    # Only the pool opened with exactly these parameters, unlike close_pools(dbname) which also
+    # closes pools to databases of the same name on other hosts or ports
+    with _POOLS_LOCK:
+        pool = _POOLS.pop(_pool_key(params), None)
+    if pool is not None:
+        pool.closeall()
@@ -0,0 +1,148 @@
+import bisect
+import functools
+import json
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Parent logger of every module; nothing below WARNING is shown unless set_verbose() is called
+LOGGER_NAME = 'partitioning'
+# Upper bounds, in seconds, of the SQL statement latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, math.inf)
+# Plans kept by the EXPLAIN capture mode; older ones are dropped first
+EXPLAIN_CAPTURE_LIMIT = 100
+# Statements EXPLAIN ANALYZE can run in place of the real one (it executes them exactly once)
+EXPLAIN_IN_PLACE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+
+def get_logger(module_name):
+    return logging.getLogger(f"{LOGGER_NAME}.{module_name}")
+
+def set_verbose(enabled=True, level=logging.INFO):
+    """
+    Show progress messages on stderr (or hide them again). Applications that configure logging
+    themselves can instead set the level of the 'partitioning' logger.
+    """
+    logger = logging.getLogger(LOGGER_NAME)
+    if not enabled:
+        logger.setLevel(logging.WARNING)
+        return
+    logger.setLevel(level)
+    if not any(getattr(handler, '_verbose_handler', False) for handler in logger.handlers):
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        handler._verbose_handler = True
+        logger.addHandler(handler)
+
+
+class Metrics:
+    """
+    Thread-safe registry of operation timers, counters and statement latency histograms.
+    snapshot() returns a plain dict that can be dumped as JSON.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.explain_enabled = False
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._timers = {}
+            self._counters = {}
+            self._histograms = {}
+            self._plans = []
+
+    def record_time(self, name, seconds):
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0}
+            timer['count'] += 1
+            timer['total_seconds'] += seconds
+            timer['max_seconds'] = max(timer['max_seconds'], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_time(name, time.perf_counter() - start)
+
+    def increment(self, name, key, value=1):
+        # Two-level counters, e.g. increment('rows_routed', 'range_part0', 10)
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe_latency(self, name, seconds):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = {'count': 0, 'total_seconds': 0.0, 'buckets': [0] * len(LATENCY_BUCKETS)}
+            histogram['count'] += 1
+            histogram['total_seconds'] += seconds
+            histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def add_plan(self, query, params, plan):
+        with self._lock:
+            self._plans.append({'query': query, 'params': None if params is None else [str(p) for p in params], 'plan': plan})
+            del self._plans[:-EXPLAIN_CAPTURE_LIMIT]
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {}
+            for name, histogram in self._histograms.items():
+                histograms[name] = {
+                    'count': histogram['count'],
+                    'total_seconds': histogram['total_seconds'],
+                    'buckets': {('+Inf' if math.isinf(bound) else f"{bound:g}"): count
+                                for bound, count in zip(LATENCY_BUCKETS, histogram['buckets'])},
+                }
+            return {
+                'timers': {name: dict(timer) for name, timer in self._timers.items()},
+                'counters': {name: dict(counter) for name, counter in self._counters.items()},
+                'statement_latency': histograms,
+                'explain_plans': list(self._plans),
+            }
+
+    def export_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+
+METRICS = Metrics()
+
+def timed(function):
+    # Records every call of @function under its name in METRICS' timers
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with METRICS.timer(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+def set_explain_capture(enabled=True):
+    """
+    Capture EXPLAIN (ANALYZE, BUFFERS) plans of the statements run through
+    _execute_query_pg_with_provided_conn. INSERT/UPDATE/DELETE are run as the EXPLAIN itself;
+    SELECT statements are explained first and then run again, so they cost twice as much.
+    Statements that call nextval() or setval() are never explained. Off by default.
+    """
+    METRICS.explain_enabled = enabled
+
+def explain_mode(kind, query, fetch):
+    # 'in_place': run the EXPLAIN instead of the statement; 'before': EXPLAIN a read first; None: skip
+    if not METRICS.explain_enabled or 'nextval(' in query or 'setval(' in query:
+        return None
+    if kind in EXPLAIN_IN_PLACE_STATEMENTS and not fetch:
+        return 'in_place'
+    if kind == 'SELECT':
+        return 'before'
+    return None
+
+def statement_kind(query):
+    # First keyword of a statement: keeps the histogram keys few and stable
+    words = query.lstrip().split(None, 1)
+    return words[0].upper() if words else ''
@@ -0,0 +1,303 @@
+import math
+import re
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import cluster
+import main
+import metrics
+from main import USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME, MIN_RATING_CONST, _execute_query_pg_with_provided_conn
+
+AGGREGATES = ('count', 'sum', 'avg', 'min', 'max')
+GROUP_BY_COLUMNS = (USER_ID_COLNAME, MOVIE_ID_COLNAME)
+PREDICATE_COLUMNS = (USER_ID_COLNAME, MOVIE_ID_COLNAME, RATING_COLNAME)
+PREDICATE_OPERATORS = ('=', '<>', '<', '<=', '>', '>=')
+# Select list entries for co-located joins: l.<column>, r.<column>, l.* or r.*
+JOIN_COLUMN_PATTERN = re.compile(r'^[lr]\.(\*|[a-z_][a-z0-9_]*)$')
+# Orderings of top_rated: best average first, or most ratings first
+TOP_ORDERINGS = {'avg': 'rating_sum / rating_count DESC', 'count': 'rating_count DESC'}
+
+# partitions: tables that were scanned; skipped: tables pruned from the plan
+QueryResult = namedtuple('QueryResult', ['values', 'partitions', 'skipped'])
+
+logger = metrics.get_logger(__name__)
+
+
+def _where_clause(predicates):
+    # predicates: iterable of (column, operator, value), combined with AND
+    conditions = []
+    params = []
+    for column, operator, value in predicates or ():
+        column = column.lower()
+        if column not in PREDICATE_COLUMNS:
+            raise ValueError(f"Unsupported predicate column '{column}'. Expected one of {PREDICATE_COLUMNS}.")
+        if operator not in PREDICATE_OPERATORS:
+            raise ValueError(f"Unsupported predicate operator '{operator}'. Expected one of {PREDICATE_OPERATORS}.")
+        conditions.append(f"{column} {operator} %s")
+        params.append(value)
+    if not conditions:
+        return "", ()
+    return "WHERE " + " AND ".join(conditions), tuple(params)
+
+def _tighten(bound, value, inclusive, pick):
+    # bound is (value, inclusive); pick is max for lower bounds and min for upper bounds
+    current, current_inclusive = bound
+    if value == current:
+        return value, current_inclusive and inclusive
+    return (value, inclusive) if pick(value, current) == value else bound
+
+def _rating_interval(predicates):
+    lower, upper = (-math.inf, True), (math.inf, True)
+    for column, operator, value in predicates or ():
+        if column.lower() != RATING_COLNAME or operator == '<>':
+            continue
+        value = float(value)
+        if operator in ('>', '>=', '='):
+            lower = _tighten(lower, value, operator != '>', max)
+        if operator in ('<', '<=', '='):
+            upper = _tighten(upper, value, operator != '<', min)
+    return lower, upper
+
+def _intervals_overlap(lower, upper):
+    (low, low_inclusive), (high, high_inclusive) = lower, upper
+    return low < high or (low == high and low_inclusive and high_inclusive)
+
+def _prune_range_partitions(scheme, predicates):
+    # Range partition 0 holds [MIN, u0] and partition i holds (u(i-1), ui].
+    query_lower, query_upper = _rating_interval(predicates)
+    keep = []
+    previous_upper = None
+    for i, upper in enumerate(scheme.boundaries):
+        partition_lower = (MIN_RATING_CONST, True) if i == 0 else (previous_upper, False)
+        lower = _tighten(partition_lower, *query_lower, max)
+        upper_bound = _tighten((upper, True), *query_upper, min)
+        keep.append(_intervals_overlap(lower, upper_bound))
+        previous_upper = upper
+    return keep
+
+def _partial_aggregate_sql(table_name, where_sql, group_by):
+    # Every partition returns count/sum/min/max so any aggregate can be merged on the client.
+    partials = f"COUNT({RATING_COLNAME}), SUM({RATING_COLNAME}), MIN({RATING_COLNAME}), MAX({RATING_COLNAME})"
+    if group_by is None:
+        return f"SELECT NULL, {partials} FROM {table_name} {where_sql};"
+    return f"SELECT {group_by}, {partials} FROM {table_name} {where_sql} GROUP BY {group_by};"
+
+def _fetch_partials(pool, query, params):
+    with pool.connection() as conn:
+        return _execute_query_pg_with_provided_conn(conn, query, params, fetch='all')
+
+def _merge_partials(partial_rows):
+    merged = {}
+    for group, count, total, minimum, maximum in partial_rows:
+        current = merged.get(group)
+        if current is None:
+            merged[group] = [count, total, minimum, maximum]
+            continue
+        current[0] += count
+        if total is not None:
+            current[1] = total if current[1] is None else current[1] + total
+        if minimum is not None:
+            current[2] = minimum if current[2] is None else min(current[2], minimum)
+        if maximum is not None:
+            current[3] = maximum if current[3] is None else max(current[3], maximum)
+    return merged
+
+def _finalize(aggregate, count, total, minimum, maximum):
+    if aggregate == 'count':
+        return count
+    if aggregate == 'sum':
+        return total
+    if aggregate == 'avg':
+        return total / count if count else None
+    if aggregate == 'min':
+        return minimum
+    return maximum
+
+@metrics.timed
+def fanout_aggregate(prefix, aggregate, openconnection, predicates=None, group_by=None, workers=None):
+    """
+    Scatter an aggregate over rating to the partitions of @prefix and gather the result.
+    Range partitions whose rating bounds cannot satisfy the rating predicates are skipped.
+    :param aggregate: one of count, sum, avg, min, max
+    :param predicates: list of (column, operator, value) tuples combined with AND
+    :param group_by: None, userid or movieid
+    :return: QueryResult whose values is a scalar, or a dict keyed by the group column,
+             plus the partition tables scanned and skipped
+    """
+    aggregate = aggregate.lower()
+    if aggregate not in AGGREGATES:
+        raise ValueError(f"Unsupported aggregate '{aggregate}'. Expected one of {AGGREGATES}.")
+    if group_by is not None:
+        group_by = group_by.lower()
+        if group_by not in GROUP_BY_COLUMNS:
+            raise ValueError(f"Unsupported group by column '{group_by}'. Expected one of {GROUP_BY_COLUMNS}.")
+    conn = openconnection
+    main._require_connection(conn, "Fanout_Aggregate")
+    scheme = main.get_partition_catalog(conn).get(conn, prefix)
+    if scheme is None:
+        raise ValueError(f"No partitions found for prefix '{prefix}'.")
+    where_sql, params = _where_clause(predicates)
+    partitions = list(range(scheme.num_partitions))
+    skipped = []
+    if scheme.scheme == 'range' and scheme.boundaries:
+        keep = _prune_range_partitions(scheme, predicates)
+        skipped = [scheme.table_name(i) for i in partitions if not keep[i]]
+        partitions = [i for i in partitions if keep[i]]
+    tables = [scheme.table_name(i) for i in partitions]
+    partial_rows = []
+    if tables:
+        queries = [(scheme.node_of(i), _partial_aggregate_sql(scheme.table_name(i), where_sql, group_by)) for i in partitions]
+        partial_rows = [row for rows in _run_per_partition(conn, queries, params, workers) for row in rows]
+    merged = _merge_partials(partial_rows)
+    if group_by is None:
+        count, total, minimum, maximum = merged.get(None, (0, None, None, None))
+        values = _finalize(aggregate, count, total, minimum, maximum)
+    else:
+        values = {group: _finalize(aggregate, *partials) for group, partials in merged.items() if partials[0]}
+    return QueryResult(values, tables, skipped)
+
+def _run_per_partition(conn, queries, params=(), workers=None):
+    # queries: (node, query) pairs; each query runs on a connection to the node holding its partition
+    pools = [cluster.pool_for_node(conn, node) for node, _ in queries]
+    workers = min(workers or len(queries), len(queries), max(pool.maxconn for pool in pools))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_fetch_partials, pool, query, params) for pool, (_, query) in zip(pools, queries)]
+        return [future.result() for future in futures]
+
+@metrics.timed
+def hash_lookup(prefix, key_value, openconnection):
+    """
+    Point lookup on the hash partitioning key: only the partition that owns @key_value is read.
+    :return: QueryResult whose values are the matching rows
+    """
+    conn = openconnection
+    main._require_connection(conn, "Hash_Lookup")
+    scheme = main.get_partition_catalog(conn).get(conn, prefix)
+    if scheme is None or scheme.scheme != 'hash':
+        raise ValueError(f"'{prefix}' is not a hash partitioned scheme.")
+    partition_index = scheme.route_key(key_value)
+    target = scheme.table_name(partition_index)
+    # Read on a pooled session, as fanout_aggregate does, so the caller's connection is left
+    # without a transaction holding locks on the partition.
+    rows = _fetch_partials(cluster.pool_for_node(conn, scheme.node_of(partition_index)),
+                           f"SELECT * FROM {target} WHERE {scheme.key_column} = %s;", (key_value,))
+    skipped = [scheme.table_name(i) for i in range(scheme.num_partitions) if scheme.table_name(i) != target]
+    return QueryResult(rows, [target], skipped)
+
+@metrics.timed
+def colocated_join(left_prefix, right_prefix, openconnection, columns=('l.*', 'r.*'), workers=None):
+    """
+    Join two tables hash partitioned on the same key with the same partition count. Partition i
+    of the left table only ever matches partition i of the right one, so the join runs
+    partition by partition, concurrently, and never moves rows between partitions.
+    :param columns: select list entries such as 'l.userid', 'r.title' or 'l.*'
+    :return: QueryResult whose values are the joined rows
+    """
+    conn = openconnection
+    main._require_connection(conn, "Colocated_Join")
+    catalog = main.get_partition_catalog(conn)
+    left, right = catalog.get(conn, left_prefix), catalog.get(conn, right_prefix)
+    for prefix, scheme in ((left_prefix, left), (right_prefix, right)):
+        if scheme is None or scheme.scheme != 'hash':
+            raise ValueError(f"'{prefix}' is not a hash partitioned scheme.")
+    if left.key_column != right.key_column or left.token_ranges() != right.token_ranges():
+        raise ValueError(f"'{left_prefix}' and '{right_prefix}' are not co-located: "
+                         f"they must be hash partitioned on the same key into the same number of partitions.")
+    if left.placement != right.placement:
+        raise ValueError(f"'{left_prefix}' and '{right_prefix}' are not co-located: "
+                         f"matching partitions must be placed on the same node.")
+    for column in columns:
+        if not JOIN_COLUMN_PATTERN.match(column):
+            raise ValueError(f"Unsupported join column '{column}'. Expected l.<column>, r.<column>, l.* or r.*.")
+    select_list = ", ".join(columns)
+    queries = [(left.node_of(i), f"SELECT {select_list} FROM {left.table_name(i)} AS l "
+                                 f"JOIN {right.table_name(i)} AS r ON l.{left.key_column} = r.{right.key_column};")
+               for i in range(left.num_partitions)]
+    rows = [row for partition_rows in _run_per_partition(conn, queries, workers=workers) for row in partition_rows]
+    pairs = [f"{left.table_name(i)}:{right.table_name(i)}" for i in range(left.num_partitions)]
+    return QueryResult(rows, pairs, [])
+
+@metrics.timed
+def build_rating_summaries(ratingsTableName, openconnection, include_users=False):
+    """
+    (Re)build the per-movie rating summary, and the per-user one with @include_users, from the
+    ratings in @ratingsTableName. Inserts into the table are blocked while it runs. Afterwards a
+    trigger on the table keeps the summaries current in every inserting transaction, whichever
+    process or loader writes the rows. Rows written only to partitions (load_file_into_partitions,
+    load_and_partition without the base table) are not part of the table and are not counted.
+    :return: dict summary table -> number of rows
+    """
+    actual_base_table_name = ratingsTableName.lower()
+    conn = openconnection
+    main._require_connection(conn, "Build_Rating_Summaries")
+    key_columns = [MOVIE_ID_COLNAME] + ([USER_ID_COLNAME] if include_users else [])
+    sizes = {}
+    try:
+        # One transaction, also on an autocommit connection. Rebuilds of any table queue on the
+        # summaries' advisory locks first, since a rebuild may move the upkeep trigger off another
+        # table. SHARE ROW EXCLUSIVE is then taken up front rather than SHARE: it waits for running
+        # inserts and blocks new ones until the summaries are committed, so no rating is counted
+        # twice or missed, and it is already the mode CREATE TRIGGER needs, so no upgrade can deadlock.
+        with main._transaction(conn):
+            for key_column in key_columns:
+                _execute_query_pg_with_provided_conn(
+                    conn, "SELECT pg_advisory_xact_lock(hashtext(%s));", (main.RATING_SUMMARY_TABLES[key_column],))
+            _execute_query_pg_with_provided_conn(
+                conn, f"LOCK TABLE {actual_base_table_name} IN SHARE ROW EXCLUSIVE MODE;")
+            for key_column in key_columns:
+                sizes[main.RATING_SUMMARY_TABLES[key_column]] = main._create_rating_summary(
+                    conn, key_column, actual_base_table_name)
+    except Exception as e:
+        logger.error("Error during Build_Rating_Summaries: %s", e)
+        raise
+    return sizes
+
+def _summary_table(conn, key_column):
+    key_column = key_column.lower()
+    if key_column not in main.RATING_SUMMARY_TABLES:
+        raise ValueError(f"Unsupported summary key '{key_column}'. Expected one of {GROUP_BY_COLUMNS}.")
+    table_name = main.RATING_SUMMARY_TABLES[key_column]
+    exists = _execute_query_pg_with_provided_conn(conn, "SELECT to_regclass(%s) IS NOT NULL;", (table_name,), fetch='one')[0]
+    if not exists:
+        raise ValueError(f"'{table_name}' does not exist. Build it with build_rating_summaries() first.")
+    return key_column, table_name
+
+@metrics.timed
+def rating_stats(key_value, openconnection, key_column=MOVIE_ID_COLNAME):
+    """
+    Average, count, min and max rating of one movie (or user, with key_column='userid'), read
+    from its summary row instead of aggregating the partitions.
+    :return: QueryResult whose values is a dict with avg, count, min and max, or None if it has no ratings
+    """
+    conn = openconnection
+    main._require_connection(conn, "Rating_Stats")
+    key_column, table_name = _summary_table(conn, key_column)
+    row = _execute_query_pg_with_provided_conn(
+        conn, f"SELECT rating_sum, rating_count, rating_min, rating_max FROM {table_name} WHERE {key_column} = %s;",
+        (key_value,), fetch='one')
+    values = None
+    if row is not None and row[1]:
+        total, count, minimum, maximum = row
+        values = {'avg': total / count, 'count': count, 'min': minimum, 'max': maximum}
+    return QueryResult(values, [table_name], [])
+
+@metrics.timed
+def top_rated(n, openconnection, key_column=MOVIE_ID_COLNAME, order_by='avg', min_count=1):
+    """
+    The @n movies (or users) with the best average rating or the most ratings, from the summary table.
+    :param order_by: 'avg' or 'count'
+    :param min_count: skip entries with fewer ratings, so a single 5-star rating does not top the list
+    :return: QueryResult whose values are (key, average rating, rating count) tuples
+    """
+    if order_by not in TOP_ORDERINGS:
+        raise ValueError(f"Unsupported ordering '{order_by}'. Expected one of {tuple(TOP_ORDERINGS)}.")
+    conn = openconnection
+    main._require_connection(conn, "Top_Rated")
+    key_column, table_name = _summary_table(conn, key_column)
+    rows = _execute_query_pg_with_provided_conn(conn, f"""
+        SELECT {key_column}, rating_sum / rating_count, rating_count FROM {table_name}
+        WHERE rating_count >= GREATEST(%s, 1)
+        ORDER BY {TOP_ORDERINGS[order_by]}, {key_column}
+        LIMIT %s;
+    """, (min_count, n), fetch='all')
+    return QueryResult(rows, [table_name], [])
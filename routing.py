@@ -0,0 +1,381 @@
+import bisect
+import queue
+import threading
+import time
+
+import psycopg2
+
+import datparser
+import dbpool
+import main
+import metrics
+from main import USER_ID_COLNAME, MOVIE_ID_COLNAME, MIN_RATING_CONST, LOAD_CHUNK_BYTES, \
+    HASH_MULTIPLIER, HASH_SPACE, RROBIN_CURSOR_SEQUENCE, _execute_query_pg_with_provided_conn
+
+try:
+    import numpy as np
+except ImportError:  # routing falls back to bisect
+    np = None
+
+logger = metrics.get_logger(__name__)
+
+# Chunks buffered between load_and_partition stages; bounds memory to a few chunks per stage
+PIPELINE_QUEUE_DEPTH = 4
+# Rows routed to no partition (e.g. a rating outside every range) get this index
+UNROUTED = -1
+
+
+def route_ratings(ratings, upper_bounds):
+    # Same rule as PartitionScheme.route_rating: bisect_left over the inclusive upper bounds
+    if np is not None:
+        ratings = np.asarray(ratings, dtype=np.float64)
+        indices = np.searchsorted(np.asarray(upper_bounds, dtype=np.float64), ratings, side='left')
+        outside = (ratings < MIN_RATING_CONST) | (indices >= len(upper_bounds)) | np.isnan(ratings)
+        return np.where(outside, UNROUTED, indices)
+    return [UNROUTED if not (MIN_RATING_CONST <= r <= upper_bounds[-1]) else bisect.bisect_left(upper_bounds, r)
+            for r in ratings]
+
+def route_roundrobin(count, first_slot, num_partitions):
+    if np is not None:
+        return (np.arange(count, dtype=np.int64) + first_slot) % num_partitions
+    return [(first_slot + i) % num_partitions for i in range(count)]
+
+def route_keys(keys, token_starts, owners):
+    # Vectorized stable_hash() followed by the token range lookup of PartitionScheme.route_key
+    if np is not None:
+        tokens = (np.asarray(keys, dtype=np.int64) * HASH_MULTIPLIER) % HASH_SPACE
+        positions = np.searchsorted(np.asarray(token_starts, dtype=np.int64), tokens, side='right') - 1
+        return np.asarray(owners, dtype=np.int64)[positions]
+    return [owners[bisect.bisect_right(token_starts, main.stable_hash(k)) - 1] for k in keys]
+
+def route_columns(scheme, userids, movieids, ratings, first_slot=0):
+    if scheme.scheme == 'range':
+        return route_ratings(ratings, scheme.boundaries)
+    if scheme.scheme == 'hash':
+        keys = userids if scheme.key_column == USER_ID_COLNAME else movieids
+        return route_keys(keys, scheme.boundaries, scheme.owners)
+    return route_roundrobin(len(ratings), first_slot, scheme.num_partitions)
+
+def reserve_roundrobin_slots(conn, count):
+    """
+    Take @count values from the round robin cursor in one round trip.
+    :return: the first slot when the values are consecutive, otherwise the sorted list of values
+             (other sessions called nextval() while the block was being taken)
+    """
+    first, values = _execute_query_pg_with_provided_conn(conn, f"""
+        SELECT MIN(v), CASE WHEN MAX(v) - MIN(v) + 1 = COUNT(*) THEN NULL ELSE array_agg(v ORDER BY v) END
+        FROM (SELECT nextval('{RROBIN_CURSOR_SEQUENCE}') AS v FROM generate_series(1, %s)) AS s;
+    """, (count,), fetch='one')
+    return first if values is None else values
+
+def partition_copy_buffers(userids, movieids, ratings, indices, num_partitions):
+    """
+    Group routed rows by partition and encode each group as a COPY binary payload.
+    :return: dict partition index -> (row count, BytesIO), unrouted rows are left out
+    """
+    buffers = {}
+    if np is not None:
+        indices = np.asarray(indices)
+        order = np.argsort(indices, kind='stable')
+        sorted_indices = indices[order]
+        bounds = np.searchsorted(sorted_indices, np.arange(num_partitions + 1), side='left')
+        for p in range(num_partitions):
+            rows = order[bounds[p]:bounds[p + 1]]
+            if len(rows):
+                buffers[p] = (len(rows), main._rating_copy_buffer(userids[rows], movieids[rows], ratings[rows]))
+        return buffers
+    groups = {}
+    for u, m, r, p in zip(userids, movieids, ratings, indices):
+        if p != UNROUTED:
+            groups.setdefault(p, ([], [], []))
+            groups[p][0].append(u)
+            groups[p][1].append(m)
+            groups[p][2].append(r)
+    for p, (us, ms, rs) in groups.items():
+        buffers[p] = (len(rs), main._rating_copy_buffer(us, ms, rs))
+    return buffers
+
+def _roundrobin_indices(conn, scheme, count):
+    slots = reserve_roundrobin_slots(conn, count)
+    if isinstance(slots, list):
+        if np is not None:
+            return np.asarray(slots, dtype=np.int64) % scheme.num_partitions
+        return [v % scheme.num_partitions for v in slots]
+    return route_roundrobin(count, slots, scheme.num_partitions)
+
+def _copy_range_into_partitions(conn, scheme, ratingsFilePath, chunk_bytes, start=0, end=None):
+    total_rows = skipped = unrouted = 0
+    partition_rows = {}
+    timings = {'parse_seconds': 0.0, 'write_seconds': 0.0}
+    with conn.cursor() as cur:
+        chunks = main._timed_chunks(datparser.iter_rating_columns(ratingsFilePath, chunk_bytes, start, end), timings)
+        for userids, movieids, ratings, bad in chunks:
+            skipped += bad
+            if not len(ratings):
+                continue
+            if scheme.scheme in ('range', 'hash'):
+                indices = route_columns(scheme, userids, movieids, ratings)
+            else:
+                indices = _roundrobin_indices(conn, scheme, len(ratings))
+            buffers = partition_copy_buffers(userids, movieids, ratings, indices, scheme.num_partitions)
+            write_started = time.perf_counter()
+            for p, (count, buf) in buffers.items():
+                table_name = scheme.table_name(p)
+                main._copy_rating_buffer(cur, table_name, buf)
+                partition_rows[table_name] = partition_rows.get(table_name, 0) + count
+                total_rows += count
+            timings['write_seconds'] += time.perf_counter() - write_started
+            unrouted += len(ratings) - sum(count for count, _ in buffers.values())
+    return total_rows, skipped, unrouted, partition_rows, timings
+
+def _load_partition_range(params, prefix, ratingsFilePath, chunk_bytes, start, end):
+    # Runs in a loader process, over that process's own connection
+    with dbpool.connection(**params) as conn:
+        scheme = main._pin_partition_scheme(conn, prefix)
+        if scheme is None:
+            raise ValueError(f"No partitions found for prefix '{prefix}'.")
+        result = _copy_range_into_partitions(conn, scheme, ratingsFilePath, chunk_bytes, start, end)
+        conn.commit()
+    return result
+
+def _count_partition_rows(conn, scheme):
+    selects = " UNION ALL ".join(f"SELECT COUNT(*) AS c FROM {scheme.table_name(i)}" for i in range(scheme.num_partitions))
+    return _execute_query_pg_with_provided_conn(conn, f"SELECT COALESCE(SUM(c), 0) FROM ({selects}) AS t;", fetch='one')[0]
+
+@metrics.timed
+def load_file_into_partitions(ratingsFilePath, prefix, openconnection, chunk_bytes=LOAD_CHUNK_BYTES, workers=None):
+    """
+    Route a ratings file straight into the existing partitions of @prefix, without staging the
+    rows in the base table. Each chunk is routed on the client and written with one binary COPY
+    per partition; the whole file is loaded in a single transaction.
+    With @workers > 1, line-aligned byte ranges of the file are loaded by a pool of processes, each
+    range in its own transaction, and the partitions' row count is checked at the end.
+    :return: load stats plus 'partition_rows', the number of rows written to each partition table
+    """
+    if chunk_bytes <= 0:
+        raise ValueError("chunk_bytes must be greater than 0 for load_file_into_partitions.")
+    conn = openconnection
+    main._require_connection(conn, "Load_File_Into_Partitions")
+    scheme = main.get_partition_catalog(conn).get(conn, prefix)
+    if scheme is None:
+        raise ValueError(f"No partitions found for prefix '{prefix}'.")
+    if scheme.has_remote_partitions():
+        raise ValueError(f"'{prefix}' has partitions on other nodes; load_file_into_partitions only writes local partitions.")
+    start = time.perf_counter()
+    extra = {}
+    try:
+        if workers and workers > 1:
+            rows_before = _count_partition_rows(conn, scheme)
+            if not conn.autocommit:
+                conn.commit()
+            results, errors = main._load_ranges_in_processes(conn, ratingsFilePath, workers, _load_partition_range,
+                                                             prefix, ratingsFilePath, chunk_bytes)
+            if errors:
+                logger.error("%d range(s) failed; %d row(s) committed by the other ranges remain in '%s'.",
+                             len(errors), sum(result[0] for result in results), prefix)
+                raise errors[0]
+            total_rows, skipped, unrouted = (sum(result[i] for result in results) for i in range(3))
+            partition_rows = {}
+            for result in results:
+                for table_name, count in result[3].items():
+                    partition_rows[table_name] = partition_rows.get(table_name, 0) + count
+            timings = main._sum_timings(results)
+            rows_after = _count_partition_rows(conn, scheme)
+            if rows_after - rows_before != total_rows:
+                raise RuntimeError(f"Row count check failed for '{prefix}': loaded {total_rows} rows "
+                                   f"but the partitions grew by {rows_after - rows_before}.")
+            extra['workers'] = workers
+        else:
+            scheme = main._pin_partition_scheme(conn, prefix)
+            if scheme is None:
+                raise ValueError(f"No partitions found for prefix '{prefix}'.")
+            total_rows, skipped, unrouted, partition_rows, timings = _copy_range_into_partitions(
+                conn, scheme, ratingsFilePath, chunk_bytes)
+        if not conn.autocommit:
+            conn.commit()
+    except Exception as e:
+        logger.error("Error during Load_File_Into_Partitions: %s", e)
+        if dbpool.is_usable(conn) and not conn.autocommit:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        raise
+    if unrouted:
+        logger.warning("%d rating(s) outside every partition of '%s' were not loaded.", unrouted, prefix)
+    return main._load_stats(prefix, total_rows, skipped, start, unrouted=unrouted, partition_rows=partition_rows,
+                            **extra, **timings)
+
+_END_OF_STREAM = object()
+
+def _put(outbox, item, stop):
+    # A bounded put that gives up once a downstream stage has failed and stopped reading
+    while not stop.is_set():
+        try:
+            outbox.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _drain(inbox, stop):
+    while not stop.is_set():
+        try:
+            item = inbox.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _END_OF_STREAM:
+            return
+        yield item
+
+def _run_stage(produce, outbox, stop, errors):
+    # One pipeline thread: forwards what @produce yields, then the end-of-stream marker, which
+    # is also sent after a failure so the next stage does not wait forever.
+    try:
+        for item in produce():
+            if not _put(outbox, item, stop):
+                break
+    except Exception as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        _put(outbox, _END_OF_STREAM, stop)
+
+def _partition_scheme_for_load(prefix, scheme, base_table, n, key):
+    if scheme == 'range':
+        return main.PartitionScheme(prefix, 'range', base_table, n, main._range_upper_bounds(n))
+    if scheme == 'hash':
+        return main.PartitionScheme(prefix, 'hash', base_table, n, main._hash_token_starts(n), key, list(range(n)))
+    return main.PartitionScheme(prefix, 'roundrobin', base_table, n)
+
+@metrics.timed
+def load_and_partition(ratingsTableName, ratingsFilePath, scheme, numberOfPartitions, openconnection, key=None,
+                       load_base_table=True, chunk_bytes=LOAD_CHUNK_BYTES, queue_depth=PIPELINE_QUEUE_DEPTH,
+                       build_indexes=False):
+    """
+    Load a ratings file and partition it in a single pass, instead of loadratings followed by
+    rangepartition / roundrobinpartition / hashpartition. Parsing and routing run in two threads and
+    COPY in the calling thread, connected by bounded queues, so reading the file overlaps with
+    writing to the database.
+    The partitions (and the base table, with @load_base_table) are written in one transaction.
+    The partitions are rebuilt from the file alone, so with @load_base_table the base table must
+    be new or empty; otherwise it would hold rows the partitions do not.
+    :param scheme: 'range' (equal width), 'roundrobin' or 'hash'
+    :param key: userid or movieid, hash partitioning only
+    :param build_indexes: index and ANALYZE the partitions once they are loaded (main.build_partition_indexes)
+    :return: load stats plus 'partition_rows' and per stage busy time in 'stage_seconds'
+    """
+    actual_base_table_name = ratingsTableName.lower()
+    n = numberOfPartitions
+    if n <= 0:
+        raise ValueError("numberOfPartitions must be greater than 0 for load_and_partition.")
+    if chunk_bytes <= 0 or queue_depth <= 0:
+        raise ValueError("chunk_bytes and queue_depth must be greater than 0 for load_and_partition.")
+    if scheme == 'range':
+        prefix = main.RANGE_TABLE_PREFIX
+    elif scheme == 'roundrobin':
+        prefix = main.RROBIN_TABLE_PREFIX
+    elif scheme == 'hash':
+        key = (key or '').lower()
+        if key not in (USER_ID_COLNAME, MOVIE_ID_COLNAME):
+            raise ValueError(f"Hash partitioning key must be '{USER_ID_COLNAME}' or '{MOVIE_ID_COLNAME}', got '{key}'.")
+        prefix = main.hash_table_prefix(actual_base_table_name)
+    else:
+        raise ValueError(f"Unknown partitioning scheme '{scheme}'. Expected 'range', 'roundrobin' or 'hash'.")
+    conn = openconnection
+    main._require_connection(conn, "Load_And_Partition")
+    partitions = _partition_scheme_for_load(prefix, scheme, actual_base_table_name, n, key)
+    logger.info("Loading '%s' into %d %s partitions of '%s'...", ratingsFilePath, n, scheme, actual_base_table_name)
+    start = time.perf_counter()
+    stop = threading.Event()
+    errors = []
+    busy = {'parse': 0.0, 'route': 0.0, 'write': 0.0}
+    parsed, routed = queue.Queue(queue_depth), queue.Queue(queue_depth)
+    routed_rows = [0]
+
+    def parse_chunks():
+        chunks = datparser.iter_rating_columns(ratingsFilePath, chunk_bytes)
+        while True:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+            busy['parse'] += time.perf_counter() - started
+            if chunk is None:
+                return
+            yield chunk
+
+    def route_chunks():
+        for userids, movieids, ratings, bad in _drain(parsed, stop):
+            started = time.perf_counter()
+            indices = route_columns(partitions, userids, movieids, ratings, first_slot=routed_rows[0])
+            routed_rows[0] += len(ratings)
+            buffers = partition_copy_buffers(userids, movieids, ratings, indices, n)
+            base_buffer = main._rating_copy_buffer(userids, movieids, ratings) if load_base_table and len(ratings) else None
+            busy['route'] += time.perf_counter() - started
+            yield buffers, base_buffer, bad, len(ratings)
+
+    stages = [threading.Thread(target=_run_stage, args=(parse_chunks, parsed, stop, errors), daemon=True),
+              threading.Thread(target=_run_stage, args=(route_chunks, routed, stop, errors), daemon=True)]
+    total_rows = skipped = unrouted = 0
+    partition_rows = {}
+    try:
+        with main._NodeTransactions() as node_transactions:
+            # One transaction even on an autocommit connection: the locks below need one, and a
+            # failed load must leave neither partitions nor base table rows behind.
+            with main._transaction(conn):
+                main._lock_partition_meta(conn, prefix)
+                previous = main._load_partition_scheme(conn, prefix)
+                with conn.cursor() as cur:
+                    if load_base_table:
+                        main.create_partition_table(cur, actual_base_table_name)
+                        # Self-exclusive, so no other session adds rows between the check and the COPY
+                        _execute_query_pg_with_provided_conn(
+                            conn, f"LOCK TABLE {actual_base_table_name} IN SHARE ROW EXCLUSIVE MODE;")
+                        if _execute_query_pg_with_provided_conn(
+                                conn, f"SELECT EXISTS (SELECT 1 FROM {actual_base_table_name});", fetch='one')[0]:
+                            raise ValueError(f"'{actual_base_table_name}' already holds rows; load_and_partition rebuilds the partitions "
+                                             f"from the file alone. Load into a new or empty table.")
+                    for i in range(n):
+                        table_name = partitions.table_name(i)
+                        _execute_query_pg_with_provided_conn(conn, f"DROP TABLE IF EXISTS {table_name} CASCADE;")
+                        main.create_partition_table(cur, table_name)
+                    for stage in stages:
+                        stage.start()
+                    for buffers, base_buffer, bad, count in _drain(routed, stop):
+                        write_started = time.perf_counter()
+                        if base_buffer is not None:
+                            main._copy_rating_buffer(cur, actual_base_table_name, base_buffer)
+                        for p, (rows, buf) in buffers.items():
+                            table_name = partitions.table_name(p)
+                            main._copy_rating_buffer(cur, table_name, buf)
+                            partition_rows[table_name] = partition_rows.get(table_name, 0) + rows
+                            total_rows += rows
+                        skipped += bad
+                        unrouted += count - sum(rows for rows, _ in buffers.values())
+                        busy['write'] += time.perf_counter() - write_started
+                    if errors:
+                        raise errors[0]
+                    # Partitions are written locally; ones a previous scheme kept on other nodes are dropped
+                    # there, once this transaction has committed.
+                    main._place_on_nodes(conn, node_transactions, previous, [partitions.table_name(i) for i in range(n)], None)
+                    main._save_partition_meta(conn, prefix, partitions.scheme, actual_base_table_name, n,
+                                              partitions.boundaries, partitions.key_column,
+                                              partitions.owners if scheme == 'hash' else None)
+                    if scheme == 'roundrobin':
+                        main._reset_roundrobin_cursor(conn, routed_rows[0])
+                    main.invalidate_partition_catalog(conn, prefix)
+            node_transactions.commit()
+    except Exception as e:
+        stop.set()
+        logger.error("Error during Load_And_Partition: %s", e)
+        raise
+    finally:
+        for stage in stages:
+            if stage.ident is not None:
+                stage.join()
+    if unrouted:
+        logger.warning("%d rating(s) outside every partition were not written to '%s'.", unrouted, prefix)
+    stats = main._load_stats(prefix, total_rows, skipped, start, unrouted=unrouted, partition_rows=partition_rows,
+                             parse_seconds=busy['parse'], write_seconds=busy['write'], stage_seconds=busy)
+    if build_indexes:
+        main.build_partition_indexes(prefix, conn)
+    return stats
@@ -1,6 +1,8 @@
 import traceback
 import psycopg2
 
+import dbpool
+
 RANGE_TABLE_PREFIX = 'range_part'
 RROBIN_TABLE_PREFIX = 'rrobin_part'
 USER_ID_COLNAME = 'userid'
@@ -32,6 +34,8 @@ def createdb(dbname):
     con.close()
 
 def delete_db(dbname):
+    # Idle pooled connections to the database would block DROP DATABASE
+    dbpool.close_pools(dbname)
     con = getopenconnection(dbname = 'postgres')
     con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
     cur = con.cursor()
@@ -52,7 +56,7 @@ def deleteAllPublicTables(openconnection):
     cur.close()
 
 def getopenconnection(user='postgres', password='1234', dbname='postgres'):
-    return psycopg2.connect("dbname='" + dbname + "' user='" + user + "' host='localhost' password='" + password + "'")
+    return dbpool.get_pool(dbname=dbname, user=user, host='localhost', password=password).getconn()
 
 
 ####### Tester support
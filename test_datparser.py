@@ -0,0 +1,121 @@
+import random
+
+import numpy as np
+import pytest
+
+import datparser
+from datparser import parse_dat_bytes, parse_rating_bytes
+
+
+def _rating_lines(data):
+    # The per-line parser alone, as the reference every block must agree with
+    userids, movieids, ratings, skipped = datparser._rating_block_lines(data)
+    return [list(userids), list(movieids), list(ratings), skipped]
+
+def _as_lists(parsed):
+    return [list(column) for column in parsed[:3]] + [parsed[3]]
+
+def _rating_file(rows, rng, timestamps=True):
+    lines = []
+    for _ in range(rows):
+        fields = [str(rng.randrange(1, 100000)), str(rng.randrange(1, 100000)), str(rng.randrange(0, 11) / 2)]
+        if timestamps:
+            fields.append(str(rng.randrange(10 ** 9, 2 * 10 ** 9)))
+        lines.append('::'.join(fields))
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def test_regular_block_takes_the_numpy_path():
+    data = _rating_file(200, random.Random(1))
+    assert datparser._rating_block_fast(data) is not None
+    assert _as_lists(parse_rating_bytes(data)) == _rating_lines(data)
+
+def test_rows_with_different_field_counts_are_not_misaligned():
+    data = b'1::10::4.0::100\n2::20::3.0\n3::30::5.0::300::9\n'
+    assert datparser._rating_block_fast(data) is None
+    assert _as_lists(parse_rating_bytes(data)) == [[1, 2, 3], [10, 20, 30], [4.0, 3.0, 5.0], 0]
+
+@pytest.mark.parametrize("data", [
+    b'1::10::::4.0\n2::20::3.0::5\n',         # empty field balanced by an extra one
+    b'1::10::4.0 5\n2::20::3.0::7\n',         # space inside a field
+    b'1::10::4.0\r5\n2::20::3.0::7\n',        # carriage return inside a line
+    b'1:::10::4.0\n2::20::3.0\n',             # stray colon
+    b'::1::4.0\n2::20::3.0\n',                # leading separator
+])
+def test_irregular_lines_fall_back_to_the_line_parser(data):
+    assert datparser._rating_block_fast(data) is None
+
+def test_short_and_blank_lines_are_skipped():
+    data = b'1::10::4.0\n\n2::20\n3::30::2.5\n'
+    assert _as_lists(parse_rating_bytes(data)) == [[1, 3], [10, 30], [4.0, 2.5], 1]
+
+def test_crlf_line_breaks():
+    data = b'1::10::4.0::100\r\n2::20::3.5::200\r\n'
+    assert datparser._rating_block_fast(data) is not None
+    assert _as_lists(parse_rating_bytes(data)) == [[1, 2], [10, 20], [4.0, 3.5], 0]
+
+def test_last_line_without_newline():
+    assert _as_lists(parse_rating_bytes(b'1::10::4.0\n2::20::3.5')) == [[1, 2], [10, 20], [4.0, 3.5], 0]
+
+def test_id_beyond_int_range_raises_instead_of_wrapping():
+    with pytest.raises(OverflowError):
+        parse_rating_bytes(b'3000000000::1::4.0\n')
+    with pytest.raises(OverflowError):
+        parse_rating_bytes(b'1::-2147483649::4.0\n')
+
+def test_int_range_limits_are_inclusive():
+    userids, movieids, _, _ = parse_rating_bytes(b'2147483647::-2147483648::4.0\n')
+    assert userids.tolist() == [2147483647] and movieids.tolist() == [-2147483648]
+
+@pytest.mark.parametrize("data", [b'1.5::10::4.0\n', b'1::1e3::4.0\n', b'1::x::4.0\n'])
+def test_malformed_ids_raise(data):
+    with pytest.raises(ValueError):
+        parse_rating_bytes(data)
+
+def test_one_bad_line_keeps_the_rest_of_a_large_chunk_on_the_numpy_path(monkeypatch):
+    rng = random.Random(2)
+    data = _rating_file(3000, rng) + b'7::8::4.0::1::extra::fields\n' + _rating_file(3000, rng)
+    expected = _rating_lines(data)
+    slow_blocks = []
+    block_lines = datparser._rating_block_lines
+    monkeypatch.setattr(datparser, '_rating_block_lines', lambda block: slow_blocks.append(block) or block_lines(block))
+    assert _as_lists(parse_rating_bytes(data)) == expected
+    assert sum(map(len, slow_blocks)) <= datparser.LINE_PARSE_BLOCK_BYTES
+
+def test_random_corruption_matches_the_line_parser():
+    rng = random.Random(3)
+    for _ in range(200):
+        data = bytearray(_rating_file(rng.randrange(1, 30), rng, timestamps=rng.random() < 0.5))
+        for _ in range(rng.randrange(1, 3)):
+            data[rng.randrange(len(data))] = rng.choice(b':\n\r 0.-')
+        data = bytes(data)
+        try:
+            expected = _rating_lines(data)
+        except (ValueError, OverflowError) as e:
+            with pytest.raises(type(e)):
+                parse_rating_bytes(data)
+            continue
+        assert _as_lists(parse_rating_bytes(data)) == expected
+
+def test_without_numpy(monkeypatch):
+    monkeypatch.setattr(datparser, 'np', None)
+    userids, movieids, ratings, skipped = parse_rating_bytes(b'1::10::4.0\n2::20::3.5::9\n')
+    assert (list(userids), list(movieids), list(ratings), skipped) == ([1, 2], [10, 20], [4.0, 3.5], 0)
+
+
+def test_dat_columns_with_text():
+    columns, skipped = parse_dat_bytes('1::Toy Story (1995)::Animation|Comedy\n2::Heat::a::b\nbad\n'.encode(), 'iss')
+    assert columns[0].tolist() == [1, 2]
+    assert columns[1:] == [['Toy Story (1995)', 'Heat::a'], ['Animation|Comedy', 'b']] and skipped == 1
+
+def test_dat_int64_beyond_float_precision_is_exact():
+    big = 2 ** 53 + 1
+    columns, _ = parse_dat_bytes(f'1::{big}\n2::3\n'.encode(), 'iq')
+    assert columns[1].tolist() == [big, 3]
+
+def test_dat_numeric_block():
+    data = b'1::5::1.5\n2::6::2.5\n'
+    assert datparser._dat_block_fast(data, 'iqd') is not None
+    columns, skipped = parse_dat_bytes(data, 'iqd')
+    assert [column.tolist() for column in columns] == [[1, 2], [5, 6], [1.5, 2.5]] and skipped == 0
+    assert [column.dtype for column in columns] == [np.int32, np.int64, np.float64]
@@ -0,0 +1,138 @@
+import itertools
+import threading
+
+import pytest
+
+import main
+from main import MOVIE_ID_COLNAME, RATING_COLNAME, USER_ID_COLNAME
+from query import _prune_range_partitions, _rating_interval, build_rating_summaries
+
+INF = float('inf')
+
+
+def _scheme(bounds):
+    return main.PartitionScheme(main.RANGE_TABLE_PREFIX, 'range', None, len(bounds), bounds)
+
+def _kept(bounds, predicates):
+    return [i for i, keep in enumerate(_prune_range_partitions(_scheme(bounds), predicates)) if keep]
+
+def _matches(rating, predicates):
+    checks = {'=': rating.__eq__, '<>': rating.__ne__, '<': rating.__lt__, '<=': rating.__le__,
+              '>': rating.__gt__, '>=': rating.__ge__}
+    return all(checks[operator](value) for _, operator, value in predicates)
+
+
+def test_interval_without_rating_predicates_is_unbounded():
+    assert _rating_interval(None) == ((-INF, True), (INF, True))
+    assert _rating_interval([(USER_ID_COLNAME, '=', 3), (RATING_COLNAME, '<>', 2.0)]) == ((-INF, True), (INF, True))
+
+@pytest.mark.parametrize("operator, expected", [
+    ('=', ((2.5, True), (2.5, True))),
+    ('<', ((-INF, True), (2.5, False))),
+    ('<=', ((-INF, True), (2.5, True))),
+    ('>', ((2.5, False), (INF, True))),
+    ('>=', ((2.5, True), (INF, True))),
+])
+def test_interval_of_one_predicate(operator, expected):
+    assert _rating_interval([(RATING_COLNAME, operator, 2.5)]) == expected
+
+def test_interval_keeps_the_tightest_bounds():
+    predicates = [(RATING_COLNAME, '>=', 1.0), (RATING_COLNAME, '>', 2.0), (RATING_COLNAME, '<=', 4.0),
+                  (RATING_COLNAME, '<', 3.5), ('Rating', '<=', '4.5')]
+    assert _rating_interval(predicates) == ((2.0, False), (3.5, False))
+
+def test_interval_exclusive_wins_at_an_equal_bound():
+    assert _rating_interval([(RATING_COLNAME, '>=', 2.0), (RATING_COLNAME, '>', 2.0)])[0] == (2.0, False)
+    assert _rating_interval([(RATING_COLNAME, '<', 2.0), (RATING_COLNAME, '<=', 2.0)])[1] == (2.0, False)
+
+
+BOUNDS = [1.0, 2.0, 3.0, 4.0, 5.0]
+
+@pytest.mark.parametrize("predicates, expected", [
+    ([], [0, 1, 2, 3, 4]),
+    ([(RATING_COLNAME, '=', 0.0)], [0]),
+    ([(RATING_COLNAME, '=', 1.0)], [0]),
+    ([(RATING_COLNAME, '=', 1.5)], [1]),
+    ([(RATING_COLNAME, '=', 5.0)], [4]),
+    ([(RATING_COLNAME, '<', 1.0)], [0]),
+    ([(RATING_COLNAME, '<=', 1.0)], [0]),
+    ([(RATING_COLNAME, '>', 1.0)], [1, 2, 3, 4]),
+    ([(RATING_COLNAME, '>=', 1.0)], [0, 1, 2, 3, 4]),
+    ([(RATING_COLNAME, '>', 2.0), (RATING_COLNAME, '<=', 4.0)], [2, 3]),
+    ([(RATING_COLNAME, '>=', 2.0), (RATING_COLNAME, '<', 4.0)], [1, 2, 3]),
+    ([(RATING_COLNAME, '>=', 2.0), (RATING_COLNAME, '<=', 2.0)], [1]),
+    ([(RATING_COLNAME, '>', 2.0), (RATING_COLNAME, '<', 2.0)], []),
+    ([(RATING_COLNAME, '<', 0.0)], []),
+    ([(RATING_COLNAME, '>', 5.0)], []),
+    ([(RATING_COLNAME, '<>', 1.5)], [0, 1, 2, 3, 4]),
+])
+def test_prune_equal_width_bounds(predicates, expected):
+    assert _kept(BOUNDS, predicates) == expected
+
+def test_prune_never_keeps_an_empty_equal_depth_partition():
+    # Repeated quantiles: partition 1 is (3.0, 3.0] and can hold no rating.
+    bounds = [3.0, 3.0, 4.0, 5.0]
+    assert _kept(bounds, []) == [0, 2, 3]
+    assert _kept(bounds, [(RATING_COLNAME, '=', 3.0)]) == [0]
+    assert _kept(bounds, [(RATING_COLNAME, '>', 3.0)]) == [2, 3]
+    assert _kept(bounds, [(RATING_COLNAME, '>=', 3.0), (RATING_COLNAME, '<=', 3.5)]) == [0, 2]
+
+@pytest.mark.parametrize("bounds", [BOUNDS, [2.5, 5.0], [3.0, 3.0, 4.0, 5.0], [0.5, 4.0, 4.5, 5.0]])
+def test_prune_keeps_the_partition_of_every_matching_rating(bounds):
+    scheme = _scheme(bounds)
+    ratings = sorted({step / 4 for step in range(-2, 23)} | set(bounds))
+    values = [0.0, 1.0, 2.5, 3.0, 4.0, 5.0]
+    single = [(RATING_COLNAME, operator, value) for operator in ('=', '<', '<=', '>', '>=') for value in values]
+    for predicates in itertools.chain(([p] for p in single), itertools.combinations(single, 2)):
+        keep = _prune_range_partitions(scheme, predicates)
+        matched = {scheme.route_rating(r) for r in ratings if _matches(r, predicates)} - {None}
+        assert all(keep[i] for i in matched), predicates
+
+
+def _summary_matches_ratings(conn, key_column):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT * FROM {main.RATING_SUMMARY_TABLES[key_column]} ORDER BY 1;")
+        summary = cur.fetchall()
+        cur.execute(f"{main._rating_summary_select_sql(key_column, 'ratings')} ORDER BY 1;")
+        return summary == cur.fetchall()
+
+def _load_ratings(conn):
+    with conn.cursor() as cur:
+        cur.execute("CREATE TABLE ratings (userid INT, movieid INT, rating FLOAT);")
+        cur.execute("INSERT INTO ratings SELECT g % 50, g % 37, (g % 11) / 2.0 FROM generate_series(1, 1000) AS g;")
+
+def test_summaries_on_autocommit_connection_follow_inserts_after_a_rebuild(autocommit_conn):
+    conn = autocommit_conn
+    _load_ratings(conn)
+    for _ in range(2):
+        sizes = build_rating_summaries('ratings', conn, include_users=True)
+        assert sizes == {main.MOVIE_SUMMARY_TABLE: 37, main.USER_SUMMARY_TABLE: 50}
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO ratings VALUES (3, 5, 4.5), (500, 500, 1.0);")
+    # The rebuild kept a single upkeep trigger, so the inserted rows are counted once.
+    assert _summary_matches_ratings(conn, MOVIE_ID_COLNAME) and _summary_matches_ratings(conn, USER_ID_COLNAME)
+
+def test_concurrent_summary_rebuilds_do_not_deadlock(autocommit_conn):
+    _load_ratings(autocommit_conn)
+    start = threading.Barrier(3)
+    errors = []
+
+    def rebuild():
+        conn = main.getopenconnection(dbname=autocommit_conn.info.dbname)
+        conn.autocommit = True
+        try:
+            start.wait()
+            for _ in range(5):
+                build_rating_summaries('ratings', conn, include_users=True)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            conn.close()
+
+    threads = [threading.Thread(target=rebuild) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert _summary_matches_ratings(autocommit_conn, MOVIE_ID_COLNAME)
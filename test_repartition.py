@@ -0,0 +1,155 @@
+import random
+
+import pytest
+
+import main
+from main import HASH_SPACE, _hash_moves, _owner_of, _range_moves, _rebalance_token_ranges
+
+
+def _initial_ranges(n):
+    starts = main._hash_token_starts(n)
+    return [(start, end, owner) for owner, (start, end) in enumerate(zip(starts, starts[1:] + [HASH_SPACE]))]
+
+def _tokens_per_owner(token_ranges):
+    owned = {}
+    for start, end, owner in token_ranges:
+        owned[owner] = owned.get(owner, 0) + end - start
+    return owned
+
+def _moved_tokens(old_ranges, new_ranges):
+    points = sorted({start for start, _, _ in old_ranges} | {start for start, _, _ in new_ranges} | {HASH_SPACE})
+    return sum(end - start for start, end in zip(points, points[1:])
+               if _owner_of(old_ranges, start) != _owner_of(new_ranges, start))
+
+
+@pytest.mark.parametrize("old_n, new_n", [(1, 2), (2, 3), (3, 2), (4, 7), (7, 4), (5, 1), (3, 3)])
+def test_rebalance_covers_token_space_with_equal_shares(old_n, new_n):
+    new_ranges = _rebalance_token_ranges(_initial_ranges(old_n), new_n)
+    assert new_ranges[0][0] == 0 and new_ranges[-1][1] == HASH_SPACE
+    assert all(previous[1] == current[0] for previous, current in zip(new_ranges, new_ranges[1:]))
+    owned = _tokens_per_owner(new_ranges)
+    assert sorted(owned) == list(range(new_n))
+    assert max(owned.values()) - min(owned.values()) <= 1
+
+@pytest.mark.parametrize("old_n, new_n", [(2, 3), (4, 5), (3, 2), (6, 4)])
+def test_rebalance_moves_only_the_tokens_that_change_share(old_n, new_n):
+    old_ranges = _initial_ranges(old_n)
+    new_ranges = _rebalance_token_ranges(old_ranges, new_n)
+    old_owned, new_owned = _tokens_per_owner(old_ranges), _tokens_per_owner(new_ranges)
+    # Shrinking partitions only give tokens away and growing ones only receive them.
+    minimum = sum(max(0, old_owned.get(p, 0) - new_owned.get(p, 0)) for p in set(old_owned) | set(new_owned))
+    assert _moved_tokens(old_ranges, new_ranges) == minimum
+
+def test_rebalance_merges_adjacent_ranges_of_one_owner():
+    new_ranges = _rebalance_token_ranges([(0, 100, 0), (100, 200, 0), (200, HASH_SPACE, 1)], 2)
+    assert all(a[2] != b[2] for a, b in zip(new_ranges, new_ranges[1:]))
+
+def test_rebalance_unchanged_count_keeps_layout():
+    ranges = _rebalance_token_ranges(_initial_ranges(2), 3)
+    assert _rebalance_token_ranges(ranges, 3) == ranges
+
+
+def test_hash_moves_cover_exactly_the_reassigned_segments():
+    old_ranges = _initial_ranges(2)
+    new_ranges = _rebalance_token_ranges(old_ranges, 3)
+    moves = _hash_moves(old_ranges, new_ranges, main.USER_ID_COLNAME)
+    assert [(source, target) for source, target, _, _ in moves] == [(0, 2), (1, 2)]
+    assert all(params is None for _, _, _, params in moves)
+    assert f">= {new_ranges[1][0]} AND" in moves[0][2] and moves[0][2].endswith(f"< {new_ranges[1][1]}")
+
+def test_hash_moves_route_every_key_to_its_new_owner():
+    old_ranges = _initial_ranges(3)
+    new_ranges = _rebalance_token_ranges(old_ranges, 5)
+    moves = _hash_moves(old_ranges, new_ranges, main.MOVIE_ID_COLNAME)
+    segments = []
+    for source, target, condition, _ in moves:
+        lower, upper = (int(part.split()[-1]) for part in condition.split(" AND "))
+        segments.append((lower, upper, source, target))
+    rng = random.Random(7)
+    for key in [rng.randrange(-10 ** 6, 10 ** 6) for _ in range(2000)]:
+        token = main.stable_hash(key)
+        old_owner, new_owner = _owner_of(old_ranges, token), _owner_of(new_ranges, token)
+        matches = [(source, target) for lower, upper, source, target in segments if lower <= token < upper]
+        assert matches == ([] if old_owner == new_owner else [(old_owner, new_owner)])
+
+def test_hash_moves_empty_for_same_layout():
+    ranges = _initial_ranges(4)
+    assert _hash_moves(ranges, ranges, main.USER_ID_COLNAME) == []
+
+
+def test_range_moves_on_growth():
+    moves = _range_moves([2.5, 5.0], [5 / 3, 10 / 3, 5.0])
+    assert moves == [(0, 1, f"{main.RATING_COLNAME} > %s AND {main.RATING_COLNAME} <= %s", (5 / 3, 2.5)),
+                     (1, 2, f"{main.RATING_COLNAME} > %s AND {main.RATING_COLNAME} <= %s", (10 / 3, 5.0))]
+
+def test_range_moves_on_shrink():
+    assert _range_moves([2.5, 5.0], [5.0]) == [
+        (1, 0, f"{main.RATING_COLNAME} > %s AND {main.RATING_COLNAME} <= %s", (2.5, 5.0))]
+
+def test_range_moves_keep_the_lowest_band():
+    # The band from MIN_RATING_CONST up to the smallest bound stays in partition 0 either way.
+    assert _range_moves([3.0, 5.0], [1.0, 5.0]) == [
+        (0, 1, f"{main.RATING_COLNAME} > %s AND {main.RATING_COLNAME} <= %s", (1.0, 3.0))]
+
+def test_range_moves_route_every_rating_to_its_new_partition():
+    old_bounds, new_bounds = [1.5, 2.0, 4.5, 5.0], [1.0, 2.5, 3.0, 3.5, 5.0]
+    moves = _range_moves(old_bounds, new_bounds)
+    for step in range(0, 51):
+        rating = step / 10
+        old_scheme = main.PartitionScheme('p', 'range', None, len(old_bounds), old_bounds)
+        new_scheme = main.PartitionScheme('p', 'range', None, len(new_bounds), new_bounds)
+        source, target = old_scheme.route_rating(rating), new_scheme.route_rating(rating)
+        matches = [(s, t) for s, t, condition, (lower, upper) in moves
+                   if (lower <= rating if ">=" in condition else lower < rating) and rating <= upper]
+        assert matches == ([] if source == target else [(source, target)])
+
+
+def _fetch(conn, query):
+    with conn.cursor() as cur:
+        cur.execute(query)
+        return cur.fetchall()
+
+def _load_ratings(conn, rows=1000):
+    with conn.cursor() as cur:
+        cur.execute("CREATE TABLE ratings (userid INT, movieid INT, rating FLOAT);")
+        cur.execute("INSERT INTO ratings SELECT g, g %% 37, (g %% 11) / 2.0 FROM generate_series(1, %s) AS g;", (rows,))
+
+@pytest.mark.parametrize("partition", [
+    lambda conn: main.rangepartition('ratings', 5, conn) or main.RANGE_TABLE_PREFIX,
+    lambda conn: main.roundrobinpartition('ratings', 4, conn) or main.RROBIN_TABLE_PREFIX,
+    lambda conn: main.hashpartition('ratings', 4, main.MOVIE_ID_COLNAME, conn),
+], ids=['range', 'roundrobin', 'hash'])
+def test_shrink_on_autocommit_connection_keeps_every_row(autocommit_conn, partition):
+    conn = autocommit_conn
+    _load_ratings(conn)
+    prefix = partition(conn)
+    old_n = main.get_partition_catalog(conn).get(conn, prefix).num_partitions
+    assert main.repartition(prefix, 2, conn)['partitions'] == 2
+    main.invalidate_partition_catalog(conn, prefix)
+    scheme = main.get_partition_catalog(conn).get(conn, prefix)
+    assert scheme.num_partitions == 2
+    for i in range(2, old_n):
+        assert _fetch(conn, f"SELECT to_regclass('{scheme.table_name(i)}');") == [(None,)]
+    partitions = [_fetch(conn, f"SELECT userid, movieid, rating FROM {scheme.table_name(i)};") for i in range(2)]
+    assert sorted(partitions[0] + partitions[1]) == sorted(_fetch(conn, "SELECT userid, movieid, rating FROM ratings;"))
+    for i, rows in enumerate(partitions):
+        if scheme.scheme == 'range':
+            assert all(scheme.route_rating(rating) == i for _, _, rating in rows)
+        elif scheme.scheme == 'hash':
+            assert all(scheme.route_key(movieid) == i for _, movieid, _ in rows)
+    if scheme.scheme == 'roundrobin':
+        assert abs(len(partitions[0]) - len(partitions[1])) <= 1
+
+def test_indexes_are_not_duplicated_on_partitions_added_by_repartition(autocommit_conn):
+    conn = autocommit_conn
+    _load_ratings(conn)
+    main.rangepartition('ratings', 2, conn, build_indexes=True)
+    main.repartition(main.RANGE_TABLE_PREFIX, 4, conn)
+    indexes = main.build_partition_indexes(main.RANGE_TABLE_PREFIX, conn)
+    assert sorted(indexes) == [f"{main.RANGE_TABLE_PREFIX}{i}" for i in range(4)]
+    for table_name, names in indexes.items():
+        # userid and movieid btrees plus the rating BRIN, each once, whatever LIKE named the copies
+        indexed = _fetch(conn, main.PARTITION_INDEXED_COLUMNS_SQL.replace('%s', f"'{table_name}'"))
+        assert sorted((column, method) for column, method, _ in indexed) == [
+            (main.MOVIE_ID_COLNAME, 'btree'), (main.RATING_COLNAME, 'brin'), (main.USER_ID_COLNAME, 'btree')]
+        assert sorted(names) == sorted(name for _, _, name in indexed)
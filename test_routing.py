@@ -0,0 +1,106 @@
+import math
+import random
+import struct
+
+import numpy as np
+import pytest
+
+import main
+import routing
+from main import HASH_SPACE, _rating_copy_buffer, _rebalance_token_ranges
+from routing import UNROUTED, partition_copy_buffers, route_keys, route_ratings, route_roundrobin
+
+# PostgreSQL's binary COPY framing and one (INT, INT, FLOAT8) tuple, spelled out independently of main
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8
+PGCOPY_TRAILER = b'\xff\xff'
+RATING_TUPLE = struct.Struct('>h i i i i i d')
+
+
+def _without_numpy(monkeypatch):
+    monkeypatch.setattr(routing, 'np', None)
+    monkeypatch.setattr(main, 'np', None)
+
+def _decode(buf):
+    data = buf.getvalue()
+    assert data[:len(PGCOPY_HEADER)] == PGCOPY_HEADER and data[-len(PGCOPY_TRAILER):] == PGCOPY_TRAILER
+    body = data[len(PGCOPY_HEADER):-len(PGCOPY_TRAILER)]
+    assert len(body) % RATING_TUPLE.size == 0
+    rows = []
+    for fields, userid_len, userid, movieid_len, movieid, rating_len, rating in RATING_TUPLE.iter_unpack(body):
+        assert (fields, userid_len, movieid_len, rating_len) == (3, 4, 4, 8)
+        rows.append((userid, movieid, rating))
+    return rows
+
+def _scheme(bounds):
+    return main.PartitionScheme(main.RANGE_TABLE_PREFIX, 'range', None, len(bounds), bounds)
+
+def _hash_scheme(token_ranges):
+    return main.PartitionScheme('h', 'hash', None, len({owner for _, _, owner in token_ranges}),
+                                [start for start, _, _ in token_ranges], main.USER_ID_COLNAME,
+                                [owner for _, _, owner in token_ranges])
+
+
+RATINGS = [-0.5, 0.0, 0.25, 0.5, 1.0, 1.0000001, 2.5, 2.75, 3.0, 4.0, 4.5, 5.0, 5.0000001, 6.0, math.nan]
+
+@pytest.mark.parametrize("bounds", [[5.0], [2.5, 5.0], [1.0, 2.0, 3.0, 4.0, 5.0], [3.0, 3.0, 4.0, 5.0], [0.5, 2.5, 4.5]])
+def test_route_ratings_matches_the_scheme_on_both_paths(bounds, monkeypatch):
+    scheme = _scheme(bounds)
+    expected = [UNROUTED if scheme.route_rating(r) is None else scheme.route_rating(r) for r in RATINGS]
+    assert route_ratings(np.array(RATINGS), bounds).tolist() == expected
+    _without_numpy(monkeypatch)
+    assert route_ratings(RATINGS, bounds) == expected
+
+@pytest.mark.parametrize("token_ranges", [
+    [(0, HASH_SPACE, 0)],
+    [(start, end, owner) for owner, (start, end) in
+     enumerate(zip(main._hash_token_starts(4), main._hash_token_starts(4)[1:] + [HASH_SPACE]))],
+    _rebalance_token_ranges([(0, HASH_SPACE // 3, 0), (HASH_SPACE // 3, 2 * HASH_SPACE // 3, 1),
+                             (2 * HASH_SPACE // 3, HASH_SPACE, 2)], 5),
+])
+def test_route_keys_matches_the_scheme_on_both_paths(token_ranges, monkeypatch):
+    scheme = _hash_scheme(token_ranges)
+    rng = random.Random(5)
+    keys = [0, 1, -1, 2 ** 31 - 1, -2 ** 31] + [rng.randrange(-2 ** 31, 2 ** 31) for _ in range(2000)]
+    expected = [scheme.route_key(key) for key in keys]
+    assert route_keys(np.array(keys, dtype=np.int32), scheme.boundaries, scheme.owners).tolist() == expected
+    _without_numpy(monkeypatch)
+    assert route_keys(keys, scheme.boundaries, scheme.owners) == expected
+
+def test_route_roundrobin_on_both_paths(monkeypatch):
+    expected = [(7 + i) % 3 for i in range(10)]
+    assert route_roundrobin(10, 7, 3).tolist() == expected
+    _without_numpy(monkeypatch)
+    assert route_roundrobin(10, 7, 3) == expected
+
+
+def test_rating_copy_buffer_layout(monkeypatch):
+    userids, movieids, ratings = [1, -2, 2 ** 31 - 1], [10, 0, -2 ** 31], [4.5, 0.0, 5.0]
+    data = _rating_copy_buffer(np.array(userids, dtype=np.int32), np.array(movieids, dtype=np.int32),
+                               np.array(ratings)).getvalue()
+    assert data == (PGCOPY_HEADER + b''.join(RATING_TUPLE.pack(3, 4, u, 4, m, 8, r)
+                                             for u, m, r in zip(userids, movieids, ratings)) + PGCOPY_TRAILER)
+    _without_numpy(monkeypatch)
+    assert _rating_copy_buffer(userids, movieids, ratings).getvalue() == data
+
+def test_empty_rating_copy_buffer():
+    empty = np.array([], dtype=np.int32)
+    assert _rating_copy_buffer(empty, empty, np.array([])).getvalue() == PGCOPY_HEADER + PGCOPY_TRAILER
+
+def test_partition_copy_buffers_group_rows_in_order_on_both_paths(monkeypatch):
+    rng = random.Random(6)
+    rows = [(rng.randrange(1, 1000), rng.randrange(1, 1000), rng.randrange(0, 11) / 2) for _ in range(500)]
+    indices = [rng.choice([UNROUTED, 0, 1, 3]) for _ in rows]
+    expected = {}
+    for row, p in zip(rows, indices):
+        if p != UNROUTED:
+            expected.setdefault(p, []).append(row)
+    userids, movieids, ratings = (list(column) for column in zip(*rows))
+    numpy_buffers = partition_copy_buffers(np.array(userids, dtype=np.int32), np.array(movieids, dtype=np.int32),
+                                           np.array(ratings), np.array(indices), 4)
+    _without_numpy(monkeypatch)
+    fallback_buffers = partition_copy_buffers(userids, movieids, ratings, indices, 4)
+    for buffers in (numpy_buffers, fallback_buffers):
+        assert sorted(buffers) == sorted(expected)
+        for p, (count, buf) in buffers.items():
+            assert count == len(expected[p])
+            assert _decode(buf) == expected[p]
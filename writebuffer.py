@@ -0,0 +1,232 @@
+import threading
+import time
+
+import psycopg2
+
+import dbpool
+import main
+import metrics
+from main import RANGE_TABLE_PREFIX, RROBIN_TABLE_PREFIX, USER_ID_COLNAME, INSERT_PAGE_SIZE, \
+    _execute_query_pg_with_provided_conn
+
+logger = metrics.get_logger(__name__)
+
+# Pending rows at which insert() flushes the buffer itself
+BUFFER_MAX_ROWS = 10000
+# Seconds the oldest pending row may wait before the background flush writes it; None disables it
+BUFFER_MAX_DELAY = 1.0
+BUFFER_SCHEMES = ('range', 'roundrobin', 'hash')
+SYNCHRONOUS_COMMIT_LEVELS = ('on', 'off', 'local', 'remote_write', 'remote_apply')
+
+
+class BufferedWriter:
+    """
+    Write-behind buffer in front of rangeinsert / roundrobininsert / hashinsert. Inserted rows are
+    routed into per-partition queues and written together, with multi-row inserts and a single
+    commit, once @max_rows are pending, @max_delay seconds after the oldest pending row, or on
+    flush() / close(). Rows are not durable until flushed.
+    :param synchronous_commit: session durability level, e.g. 'off' to stop waiting for the WAL
+           flush at commit; a server crash can then lose the last few commits, but never corrupts data
+    Errors of background flushes are raised by the next insert(); the rows that failed stay
+    buffered and are retried by the next flush. Only a partition node failing to commit after
+    the coordinator did drops the rows from the buffer, as retrying them would duplicate them.
+    """
+    def __init__(self, ratingsTableName, openconnection, scheme='range', prefix=None, max_rows=BUFFER_MAX_ROWS,
+                 max_delay=BUFFER_MAX_DELAY, synchronous_commit=None, page_size=INSERT_PAGE_SIZE):
+        if scheme not in BUFFER_SCHEMES:
+            raise ValueError(f"Unknown partitioning scheme '{scheme}'. Expected one of {BUFFER_SCHEMES}.")
+        if max_rows <= 0:
+            raise ValueError("max_rows must be greater than 0.")
+        if synchronous_commit is not None and synchronous_commit not in SYNCHRONOUS_COMMIT_LEVELS:
+            raise ValueError(f"Unknown synchronous_commit level '{synchronous_commit}'. Expected one of {SYNCHRONOUS_COMMIT_LEVELS}.")
+        main._require_connection(openconnection, "Buffered_Writer")
+        self.base_table = ratingsTableName.lower()
+        self.scheme = scheme
+        if scheme == 'range':
+            self.prefix = RANGE_TABLE_PREFIX
+        elif scheme == 'roundrobin':
+            self.prefix = RROBIN_TABLE_PREFIX
+        else:
+            self.prefix = prefix or main.hash_table_prefix(self.base_table)
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.page_size = page_size
+        # The buffer writes on its own session, so its durability level and transactions never
+        # mix with the caller's.
+        self._conn = dbpool.pool_for(openconnection).getconn()
+        self._synchronous_commit = synchronous_commit
+        if synchronous_commit is not None:
+            _execute_query_pg_with_provided_conn(
+                self._conn, "SELECT set_config('synchronous_commit', %s, false);", (synchronous_commit,))
+            self._conn.commit()
+        self._cond = threading.Condition()
+        self._rows = []
+        self._queues = {}
+        self._routed_with = None
+        self._oldest = None
+        self._error = None
+        self._closed = False
+        self._flusher = None
+        if max_delay is not None:
+            self._flusher = threading.Thread(target=self._flush_when_due, daemon=True)
+            self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _partition_scheme(self):
+        # Called outside the write transaction: a metadata read left open would block partitioning
+        # DDL in other sessions until the next flush.
+        scheme = main.get_partition_catalog(self._conn).get(self._conn, self.prefix)
+        if self._conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self._conn.commit()
+        return scheme
+
+    def _route(self, scheme, row):
+        if self.scheme == 'range':
+            return scheme.route_rating(row[2])
+        return scheme.route_key(row[0] if scheme.key_column == USER_ID_COLNAME else row[1])
+
+    def _enqueue(self, scheme, row):
+        partition_index = self._route(scheme, row)
+        if partition_index is not None:
+            self._queues.setdefault(partition_index, []).append(row)
+
+    def _raise_pending_error(self):
+        error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def insert(self, userid, movieid, rating):
+        row = (int(userid), int(movieid), float(rating))
+        with self._cond:
+            if self._closed:
+                raise ValueError("insert() on a closed BufferedWriter.")
+            self._raise_pending_error()
+            self._rows.append(row)
+            # Round robin slots are taken at flush time, in one round trip for the whole batch.
+            if self.scheme != 'roundrobin':
+                scheme = self._partition_scheme()
+                if scheme is not None:
+                    if scheme is not self._routed_with:
+                        self._regroup(scheme)
+                    else:
+                        self._enqueue(scheme, row)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            if len(self._rows) >= self.max_rows:
+                self._flush_locked()
+
+    def _regroup(self, scheme):
+        # The layout changed since the queued rows were routed (or nothing was routed yet)
+        self._queues = {}
+        self._routed_with = scheme
+        for row in self._rows:
+            self._enqueue(scheme, row)
+
+    def _flush_locked(self):
+        if not self._rows:
+            return 0
+        conn = self._conn
+        committed = False
+        try:
+            with main._NodeTransactions() as nodes:
+                # Routes with the layout current in partition_meta, locked until the commit
+                scheme = main._pin_partition_scheme(conn, self.prefix)
+                main._insert_rows(conn, self.base_table, self._rows, self.page_size)
+                if scheme is not None:
+                    if self.scheme == 'roundrobin':
+                        self._queues = {}
+                        for row, partition_index in zip(self._rows, main._next_roundrobin_partitions(conn, scheme, len(self._rows))):
+                            self._queues.setdefault(partition_index, []).append(row)
+                    elif scheme is not self._routed_with:
+                        self._regroup(scheme)
+                    unrouted = len(self._rows) - sum(len(rows) for rows in self._queues.values())
+                    if unrouted:
+                        logger.warning("%d rating(s) outside every range partition were only inserted into '%s'.", unrouted, self.base_table)
+                    main._write_partition_groups(conn, scheme, self._queues, nodes, self.page_size)
+                conn.commit()
+                committed = True
+                nodes.commit()
+        except Exception as e:
+            logger.error("Error during Buffered_Flush: %s", e)
+            if committed:
+                # The base table and local partitions hold the rows already; a retry would
+                # write them twice, so they leave the buffer with the node error.
+                self._clear()
+                raise
+            if dbpool.is_usable(conn):
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+            if self.scheme == 'roundrobin':
+                self._queues = {}
+            raise
+        flushed = len(self._rows)
+        metrics.METRICS.increment('buffered_rows_flushed', self.base_table, flushed)
+        self._clear()
+        return flushed
+
+    def _clear(self):
+        self._rows = []
+        self._queues = {}
+        self._oldest = None
+
+    def _flush_when_due(self):
+        with self._cond:
+            while not self._closed:
+                if self._oldest is None:
+                    self._cond.wait()
+                    continue
+                remaining = self._oldest + self.max_delay - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                try:
+                    self._flush_locked()
+                except Exception as e:
+                    self._error = e
+                    # Retry after another delay rather than spinning on a failing flush
+                    self._oldest = time.monotonic()
+
+    def flush(self):
+        """
+        Write every pending row and commit them together. Rows a background flush failed to
+        write are retried, and an error is raised only if they fail again.
+        :return: number of rows flushed
+        """
+        with self._cond:
+            self._error = None
+            return self._flush_locked()
+
+    def close(self):
+        """
+        Flush the pending rows, stop the background flush and give the session back to the pool.
+        The session is released even when the last flush fails; its error is raised afterwards
+        and the rows it held are lost.
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        if self._flusher is not None:
+            self._flusher.join()
+        try:
+            with self._cond:
+                self._error = None
+                self._flush_locked()
+        finally:
+            if dbpool.is_usable(self._conn) and self._synchronous_commit is not None:
+                try:
+                    self._conn.rollback()
+                    _execute_query_pg_with_provided_conn(self._conn, "RESET synchronous_commit;")
+                    self._conn.commit()
+                except psycopg2.Error:
+                    pass
+            self._conn.close()